@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+"""Compares fuzzy matching of noisy item names with `difflib` and the `ItemIndex`.
+
+python benchmarks/match_items.py --locale en-us --count 200
+"""
+
+import argparse
+import difflib
+import random
+import string
+import time
+
+from catalogscanner import catalog
+
+
+def noisy_names(names: list[str], count: int, seed: int = 0) -> list[str]:
+    """Returns names with OCR-like errors: swapped, dropped and inserted characters."""
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + " .-'"
+    noisy = []
+    for name in rng.sample(names, count):
+        chars = list(name)
+        for _ in range(rng.randint(1, 4)):
+            i = rng.randrange(len(chars) + 1)
+            match rng.randrange(3):
+                case 0 if i < len(chars):
+                    chars[i] = rng.choice(alphabet)
+                case 1 if i < len(chars):
+                    del chars[i]
+                case _:
+                    chars.insert(i, rng.choice(alphabet))
+        noisy.append("".join(chars))
+    return noisy
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark fuzzy matching of item names")
+    parser.add_argument("--locale", default="en-us", help="The item database to match against.")
+    parser.add_argument("--count", type=int, default=200, help="Number of noisy names to match.")
+    args = parser.parse_args()
+
+    item_db = catalog._get_item_db(args.locale)
+    words = noisy_names(sorted(item_db), args.count)
+
+    start = time.perf_counter()
+    expected = [next(iter(difflib.get_close_matches(word, item_db, n=1, cutoff=0.5)), None) for word in words]
+    difflib_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = catalog._get_item_index()
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matches = [index.best_match(word, args.locale, cutoff=0.5) for word in words]
+    index_time = time.perf_counter() - start
+
+    found = [match[0] if match else None for match in matches]
+    mismatches = sum(a != b for a, b in zip(expected, found))
+    print(f"{len(words)} names against {len(item_db)} items ({args.locale})")
+    print(f"difflib:   {difflib_time * 1000 / len(words):8.2f} ms/name")
+    print(f"ItemIndex: {index_time * 1000 / len(words):8.2f} ms/name (loaded in {load_time * 1000:.0f} ms)")
+    print(f"speedup:   {difflib_time / index_time:8.1f}x, {mismatches} different matches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+"""Compares recipe matching with shortlists of different sizes to comparing every candidate.
+
+python benchmarks/match_recipes.py tests/assets/input/recipes.mp4 --sizes 2 4 8 16
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from catalogscanner import recipes
+from catalogscanner.common import collect_stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the shortlist of recipe matching")
+    parser.add_argument("filename", type=Path, help="A video of scrolling through recipes.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[2, 4, 8, 16], help="Shortlist sizes to try, at least 2."
+    )
+    args = parser.parse_args()
+
+    cards = np.stack(recipes.parse_video(args.filename))
+    cards = cards[np.linalg.norm(cards[:, 28:84, 28:84].mean(axis=(1, 2)) - recipes.BG_COLOR, axis=1) >= 5]
+    recipe_table = recipes._get_recipe_table()
+    candidates = recipe_table.candidates(cards)
+
+    def match(shortlist_size: int) -> tuple[list[int], float]:
+        start = time.perf_counter()
+        with collect_stats():
+            matches = [
+                recipes._find_best_match(card, recipe_table, card_candidates, shortlist_size)
+                for card, card_candidates in zip(cards, candidates)
+            ]
+        return matches, time.perf_counter() - start
+
+    expected, exhaustive_time = match(len(recipe_table.recipes))
+    print(f"{len(cards)} cards, {np.mean([len(c) for c in candidates]):.1f} candidates per card")
+    print(f"all candidates: {exhaustive_time * 1000 / len(cards):6.2f} ms/card")
+    for size in args.sizes:
+        matches, shortlist_time = match(size)
+        hits = sum(a == b for a, b in zip(expected, matches)) / len(cards)
+        print(f"shortlist {size:3d}:  {shortlist_time * 1000 / len(cards):6.2f} ms/card, {hits:.2%} same matches")
+
+
+if __name__ == "__main__":
+    main()
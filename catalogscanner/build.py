@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+"""Builds the binary asset packs from the JSON databases and images.
+
+    catalogscanner-build
+
+Writes the item index to assets/items/index.bin and the critter, reaction and recipe
+images to an images.npy pack next to their names.json. Run it after updating the
+assets, scans otherwise fall back to the JSON databases and images.
+"""
+
+import argparse
+
+from catalogscanner import catalog, critters, reactions, recipes
+from catalogscanner.common import write_image_pack
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build the binary asset packs")
+    parser.parse_args()
+
+    index = catalog._build_item_index()
+    index.save(catalog.ITEM_INDEX_PATH)
+    print(f"Wrote {len(index)} item names of {len(index.locales)} locales to {catalog.ITEM_INDEX_PATH}")
+
+    for directory, filenames in [
+        (critters.CRITTERS_PATH, critters._get_image_filenames()),
+        (reactions.REACTIONS_PATH, reactions._get_image_filenames()),
+        (recipes.RECIPE_PATH, recipes._get_image_filenames()),
+    ]:
+        write_image_pack(directory, filenames)
+        print(f"Wrote {len(filenames)} images to {directory / 'images.npy'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+import hashlib
+import json
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from catalogscanner.common import ScanMode, ScanResult
+
+# Bump whenever a change to the scanners or OCR changes their results, so stale results are not served.
+# 2: the catalog locale is detected without OSD. 3: near-duplicate rows are deduped.
+# 4: rows are trimmed and binarized before OCR. 5: the locale is detected with the language of each script.
+CACHE_VERSION = 5
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024  # 256 MB
+
+DEFAULT_ROW_CACHE_SIZE = 64 * 1024 * 1024  # 64 MB
+
+
+def file_digest(filename: Path) -> str:
+    """Returns the sha256 hex digest of a file's content."""
+    with filename.open("rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def _scanner_version() -> str:
+    from importlib import metadata  # Deferred, slow to import and only needed once a cache is used.
+
+    try:
+        version = metadata.version("catalogscanner")
+    except metadata.PackageNotFoundError:
+        version = "dev"
+    return f"{version}/{CACHE_VERSION}"
+
+
+class _Store:
+    """Size-bounded key-value table in an SQLite database, evicting the least recently used values.
+
+    The store only holds paths, so it can be handed to worker processes and
+    threads, each operation uses its own connection.
+    """
+
+    def __init__(self, path: Path, max_size: int) -> None:
+        self.path = path
+        self.max_size = max_size
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, data TEXT NOT NULL, size INTEGER NOT NULL,"
+                " accessed REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Returns the stored values of the keys that are found."""
+        found: Dict[str, str] = {}
+        with closing(self._connect()) as db, db:
+            # Stay below SQLite's limit of query parameters.
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                placeholders = ", ".join("?" * len(batch))
+                found.update(db.execute(f"SELECT key, data FROM entries WHERE key IN ({placeholders})", batch))
+            db.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(time.time(), key) for key in found])
+        return found
+
+    def put_many(self, values: Dict[str, str]) -> None:
+        """Stores the values, evicting the least recently used ones if the store is full."""
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            db.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                [(key, data, len(data.encode("utf-8")), now) for key, data in values.items()],
+            )
+
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_size:
+                return
+            evicted = []
+            for old_key, old_size in db.execute("SELECT key, size FROM entries ORDER BY accessed"):
+                if total <= self.max_size:
+                    break
+                evicted.append((old_key,))
+                total -= old_size
+            db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+
+class ResultCache:
+    """Content addressed on-disk cache of scan results.
+
+    Results are stored in an SQLite database in the given directory, keyed by the
+    hash of the media plus the scan options. Once the stored results exceed
+    `max_size` bytes, the least recently used ones are evicted.
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.directory = directory
+        self.version = _scanner_version()
+        self._store = _Store(directory / "results.sqlite", max_size)
+
+    def key(self, digest: str, mode: str, locale: str, for_sale: bool) -> str:
+        """Builds the cache key of a media file scanned with the given options."""
+        return ":".join([digest, mode, locale, str(int(for_sale)), self.version])
+
+    def get(self, key: str) -> Optional[ScanResult]:
+        """Returns the cached result for the key, or None."""
+        if key not in (found := self._store.get_many([key])):
+            return None
+        data = json.loads(found[key])
+        data["mode"] = ScanMode[data["mode"]]
+        return ScanResult(**data)
+
+    def put(self, key: str, result: ScanResult) -> None:
+        """Stores a result, evicting the least recently used ones if the cache is full."""
+        data = {"mode": result.mode.name, "items": result.items, "locale": result.locale, "unmatched": result.unmatched}
+        self._store.put_many({key: json.dumps(data, ensure_ascii=False)})
+
+
+class RowTextCache:
+    """On-disk cache of the OCR text of catalog rows.
+
+    Item names are rendered in a fixed font, so the same row images recur across
+    catalogs. The text is keyed by a perceptual hash of the row image and the
+    Tesseract language, and evicted like the `ResultCache`.
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_ROW_CACHE_SIZE) -> None:
+        self.directory = directory
+        self.version = _scanner_version()
+        self._store = _Store(directory / "rows.sqlite", max_size)
+
+    def get_many(self, row_hashes: List[str], lang: str) -> Dict[str, str]:
+        """Returns the cached text of the rows that are found, by row hash."""
+        keys = {self._key(row_hash, lang): row_hash for row_hash in row_hashes}
+        return {keys[key]: text for key, text in self._store.get_many(list(keys)).items()}
+
+    def put_many(self, texts: Dict[str, str], lang: str) -> None:
+        """Stores the text of rows by row hash."""
+        self._store.put_many({self._key(row_hash, lang): text for row_hash, text in texts.items()})
+
+    def _key(self, row_hash: str, lang: str) -> str:
+        return ":".join([row_hash, lang, self.version])
@@ -3,20 +3,39 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 # Copyright (c) 2024 Nachtalb
 # This file contains both MIT and LGPL-3.0-or-later licensed code.
+import collections
+import concurrent.futures
+import contextvars
+import dataclasses
 import functools
+import itertools
 import logging
+import os
 import random
 import typing
 import unicodedata
 from pathlib import Path
-from typing import Iterator
+from typing import Iterable, Iterator, Optional
 
 import cv2
 import numpy as np
-import pytesseract
-from PIL import Image
 
-from catalogscanner.common import ASSET_PATH, FRAME_TYPE, ScanMode, ScanResult, read_json_asset
+from catalogscanner import ocr
+from catalogscanner.cache import RowTextCache
+from catalogscanner.common import (
+    ASSET_PATH,
+    FRAME_TYPE,
+    LOCALE_MAP,
+    ROWS_TYPE,
+    ScanMode,
+    ScanResult,
+    count,
+    read_json_asset,
+    stage,
+)
+from catalogscanner.frames import FrameSampler, FrameSource, crop_frame, open_frames, probe_resolution
+from catalogscanner.matching import HammingIndex, ItemIndex
+from catalogscanner.segments import map_segments
 
 # The expected color for the video background.
 TOP_COLOR = (110, 233, 238)
@@ -26,26 +45,7 @@ SIDE_COLOR = (180, 253, 254)
 WARDELL_COLOR = (211, 214, 248)
 NOOK_MILES_COLOR = (243, 207, 200)
 
-# Mapping supported AC:NH locales to tesseract languages.
-LOCALE_MAP: dict[str, str] = {
-    "auto": "auto",  # Automatic detection
-    "de-eu": "deu",
-    "en-eu": "eng",
-    "en-us": "eng",
-    "es-eu": "spa",
-    "es-us": "spa",
-    "fr-eu": "fra",
-    "fr-us": "fra",
-    "it-eu": "ita",
-    "ja-jp": "jpn",
-    "ko-kr": "kor",
-    "nl-eu": "nld",
-    "ru-eu": "rus",
-    "zh-cn": "chi_sim",
-    "zh-tw": "chi_tra",
-}
-
-# Mapping of Tesseract scripts to possible locales.
+# Mapping of scripts to possible locales.
 SCRIPT_MAP: dict[str, list[str]] = {
     "Japanese": ["ja-jp"],
     "Cyrillic": ["ru-eu"],
@@ -55,12 +55,55 @@ SCRIPT_MAP: dict[str, list[str]] = {
     "Latin": ["en-us", "en-eu", "fr-eu", "fr-us", "de-eu", "es-eu", "es-us", "it-eu", "nl-eu"],
 }
 
+# Region of the frames the catalog is parsed from, the item list up to the right edge with the scrollbar.
+# It starts at even coordinates, so the decoder crops the subsampled colors of the video exactly.
+FRAME_REGION = (150, 630, 634, 1280)
+
+# Height and width of the item name region of a row.
+ROW_SHAPE = (35, 415)
+
+# Rows are hashed by the mean brightness of a grid of blocks, one bit per block.
+ROW_HASH_GRID = (5, 128)
+
+# Rows whose hashes differ in at most this many bits are duplicates. In the test videos
+# different item names are at least 9 bits apart, while renders of the same row differ
+# by up to 35 bits with motion blur or the hover highlight.
+DEDUPE_MAX_DISTANCE = 4
+
+# Rows whose distances to the rows kept before them and to each other are computed at once when deduping.
+DEDUPE_BLOCK_ROWS = 256
+
+# Rows OCR'd per batch when streaming, one chunk of the smallest size worth a thread.
+STREAM_BATCH_ROWS = ocr.MIN_CHUNK_HEIGHT // ROW_SHAPE[0]
+
+# Tesseract language recognizing the item names of all Latin locales, for locale detection.
+LATIN_LANG = "script/Latin"
+
+# Tesseract languages recognizing the characters of all other scripts, to tell which script the items are in.
+NON_LATIN_LANG = "jpn+chi_sim+chi_tra+kor+rus"
+
+# Number of rows OCR'd to detect the locale, and how many of them to detect a non-Latin script from.
+LOCALE_SAMPLE_SIZE = 30
+SCRIPT_SAMPLE_SIZE = 10
+
+# Share of the sampled rows that must be items of a Latin locale to settle on it.
+MIN_LATIN_HITS = 0.2
+
 ITEMS_PATH = ASSET_PATH / "items"
 
+# Index over the item names of all locales, written by `catalogscanner-build`.
+ITEM_INDEX_PATH = ITEMS_PATH / "index.bin"
+
 
 def detect(frame: FRAME_TYPE) -> bool:
     """Detects if a given frame is showing Nook Shopping catalog."""
-    side_color = frame[150:160, -20:].mean(axis=(0, 1))
+    y1, y2, x1, x2 = FRAME_REGION
+    return _detect_region(frame[y1:y2, x1:x2])
+
+
+def _detect_region(region: FRAME_TYPE) -> bool:
+    """Detects if the `FRAME_REGION` of a frame is showing Nook Shopping catalog."""
+    side_color = region[:10, -20:].mean(axis=(0, 1))
     if np.linalg.norm(side_color - WARDELL_COLOR) < 10:
         raise AssertionError("Wardell catalog is not supported.")
     if np.linalg.norm(side_color - NOOK_MILES_COLOR) < 10:
@@ -68,12 +111,101 @@ def detect(frame: FRAME_TYPE) -> bool:
     return np.linalg.norm(side_color - SIDE_COLOR) < 10  # type: ignore[return-value]
 
 
-def scan(video_file: Path, locale: str = "en-us", for_sale: bool = False) -> ScanResult:
-    """Scans a video of scrolling through a catalog and returns all items found."""
-    item_rows = parse_video(video_file, for_sale)
-    locale = _detect_locale(item_rows, locale)
-    item_names = run_ocr(item_rows, lang=LOCALE_MAP[locale])
-    results, unmatched = match_items(item_names, locale)
+class RowArena:
+    """Growable contiguous array of item rows, indexed by row number.
+
+    Rows are copied in, so they don't keep the frames they were cut from alive.
+    """
+
+    def __init__(self, capacity: int = 64) -> None:
+        self._buffer = np.empty((capacity, *ROW_SHAPE), dtype=np.uint8)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index: int | slice) -> FRAME_TYPE:
+        return self.rows[index]
+
+    @property
+    def rows(self) -> FRAME_TYPE:
+        """The rows added so far, as a view of shape (N, 35, 415)."""
+        return self._buffer[: self._size]
+
+    def extend(self, rows: list[FRAME_TYPE]) -> None:
+        """Copies the rows to the end of the arena, doubling its capacity when full."""
+        if self._size + len(rows) > len(self._buffer):
+            buffer = np.empty((max(2 * len(self._buffer), self._size + len(rows)), *ROW_SHAPE), dtype=np.uint8)
+            buffer[: self._size] = self.rows
+            self._buffer = buffer
+        for row in rows:
+            self._buffer[self._size] = row
+            self._size += 1
+
+
+class RowDeduper:
+    """Drops blank rows and rows within `max_distance` bits of a row kept before, batch by batch."""
+
+    def __init__(self, max_distance: int = DEDUPE_MAX_DISTANCE) -> None:
+        self.max_distance = max_distance
+        self._index = HammingIndex(np.empty((0, ROW_HASH_GRID[0] * ROW_HASH_GRID[1] // 64), dtype=np.uint64))
+
+    def dedupe(self, rows: FRAME_TYPE) -> FRAME_TYPE:
+        """Returns the rows that are neither blank nor duplicates of a row kept before, in order."""
+        non_blank = np.flatnonzero(rows.min(axis=(1, 2)) <= 150)
+        hashes = _row_hashes(rows[non_blank])
+        kept = np.zeros(len(hashes), dtype=bool)
+        # Blocks of rows are compared to the rows kept before them and to each other, so no
+        # distance matrix grows with the square of the rows.
+        for start in range(0, len(hashes), DEDUPE_BLOCK_ROWS):
+            block = hashes[start : start + DEDUPE_BLOCK_ROWS]
+            block_kept = np.all(self._index.distances(block) > self.max_distance, axis=1)
+            if self.max_distance == 0:
+                # Only identical hashes are duplicates, keep the first row of each.
+                first = np.zeros(len(block), dtype=bool)
+                first[np.unique(block, axis=0, return_index=True)[1]] = True
+                block_kept = np.logical_and(block_kept, first)
+            else:
+                # A row is a duplicate if it is close to an earlier row that is kept. Only rows
+                # close to any earlier row need to look at which of those were kept.
+                close = np.tril(HammingIndex(block).distances(block) <= self.max_distance, k=-1)
+                for i in np.flatnonzero(np.logical_and(block_kept, close.any(axis=1))).tolist():
+                    block_kept[i] = not (close[i, :i] & block_kept[:i]).any()
+            kept[start : start + len(block)] = block_kept
+            self._index.add(block[block_kept])
+
+        count("rows_blank", len(rows) - len(non_blank))
+        count("rows_duplicate", len(non_blank) - int(np.count_nonzero(kept)))
+        return rows.take(non_blank[kept], axis=0)
+
+
+def scan(
+    video_file: Path | FrameSource,
+    locale: str = "en-us",
+    for_sale: bool = False,
+    jobs: int = 1,
+    ocr_cache: Optional[RowTextCache] = None,
+    stream: bool = False,
+) -> ScanResult:
+    """Scans a video of scrolling through a catalog and returns all items found.
+
+    With `stream`, rows are OCR'd in batches while the video is still being parsed, see `_scan_stream`.
+    """
+    if stream:
+        return _scan_stream(video_file, locale, for_sale, ocr_cache)
+
+    with stage("parse"):
+        item_rows = parse_video(video_file, for_sale, jobs)
+    count("rows", len(item_rows))
+    with stage("detect_locale"):
+        locale, known_names = _detect_locale(item_rows, locale)
+    with stage("ocr"):
+        # Rows already recognized as items while detecting the locale are not OCR'd again.
+        if known_names:
+            item_rows = np.delete(item_rows, list(known_names), axis=0)
+        item_names = run_ocr(item_rows, lang=LOCALE_MAP[locale], cache=ocr_cache) | set(known_names.values())
+    with stage("match"):
+        results, unmatched = match_items(item_names, locale)
 
     return ScanResult(
         mode=ScanMode.CATALOG,
@@ -83,81 +215,252 @@ def scan(video_file: Path, locale: str = "en-us", for_sale: bool = False) -> Sca
     )
 
 
-def parse_video(filename: Path, for_sale: bool = False) -> list[FRAME_TYPE]:
-    """Parses a whole video and returns an image containing all the items found."""
-    unfinished_page = False
-    item_scroll_count = 0
-    all_rows: list[FRAME_TYPE] = []
-    for i, frame in enumerate(_read_frames(filename)):
-        if not unfinished_page and i % 3 != 0:
-            continue  # Only parse every third frame (3 frames per page)
-        new_rows = list(_parse_frame(frame, for_sale))
-        if _is_duplicate_rows(all_rows, new_rows):
-            continue  # Skip non-moving frames
+def _scan_stream(
+    video_file: Path | FrameSource, locale: str, for_sale: bool, ocr_cache: Optional[RowTextCache]
+) -> ScanResult:
+    """Scans a catalog video, OCR'ing and matching batches of new rows while parsing continues.
+
+    The locale is detected on the first batch. The video is parsed in a single process,
+    batches are OCR'd by a thread each.
+    """
+    deduper = RowDeduper()
+    pending: list[FRAME_TYPE] = []
+    futures: list[concurrent.futures.Future[set[str]]] = []
+    item_names: set[str] = set()
+    matched_items: set[str] = set()
+    no_match_items: list[str] = []
+    row_count = parsed_count = 0
+
+    def match_new(names: set[str]) -> None:
+        for item in sorted(names - item_names):
+            if (match := _match_item(item, locale)) is None:
+                no_match_items.append(item)
+            else:
+                matched_items.add(match)
+        item_names.update(names)
+
+    def submit(rows: FRAME_TYPE) -> None:
+        nonlocal locale, row_count
+        if locale == "auto":
+            with stage("detect_locale"):
+                locale, known_names = _detect_locale(rows, locale)
+            match_new(set(known_names.values()))
+            row_count += len(known_names)
+            rows = np.delete(rows, list(known_names), axis=0)
+
+        row_count += len(rows)
+        futures.append(
+            pool.submit(contextvars.copy_context().run, _run_stream_ocr, rows, LOCALE_MAP[locale], ocr_cache)
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="OCR") as pool:
+        all_rows = RowArena()
+        with stage("parse"):
+            for _ in _parse_frames(video_file, for_sale, all_rows):
+                # Only the rows of the new page are deduped, the rest were seen before.
+                pending.append(deduper.dedupe(all_rows[parsed_count:]))
+                parsed_count = len(all_rows)
+                if sum(map(len, pending)) >= STREAM_BATCH_ROWS:
+                    submit(np.concatenate(pending))
+                    pending = []
+
+                # Match the text of the batches that are done while parsing goes on.
+                while futures and futures[0].done():
+                    match_new(futures.pop(0).result())
+
+        assert len(all_rows), "No items found, invalid video?"
+        if pending:
+            submit(np.concatenate(pending))
+        for future in futures:
+            match_new(future.result())
+
+    count("rows", row_count)
+    assert len(no_match_items) <= 0.3 * len(item_names), "Failed to match multiple items, wrong language?"
+    if no_match_items:
+        logging.warning("Failed to match %d items: %s", len(no_match_items), no_match_items)
+
+    return ScanResult(
+        mode=ScanMode.CATALOG,
+        items=sorted(matched_items),
+        locale=locale,
+        unmatched=sorted(no_match_items),
+    )
+
+
+def _run_stream_ocr(item_rows: FRAME_TYPE, lang: str, cache: Optional[RowTextCache]) -> set[str]:
+    with stage("ocr"):
+        return run_ocr(item_rows, lang, workers=1, cache=cache)
+
+
+def parse_video(
+    filename: Path | FrameSource, for_sale: bool = False, jobs: int = 1, max_distance: int = DEDUPE_MAX_DISTANCE
+) -> FRAME_TYPE:
+    """Parses a whole video and returns an array of shape (N, 35, 415) of all the item rows found.
+
+    With more than one job, segments of the video are parsed in parallel processes. Rows
+    with hashes at most `max_distance` bits apart are treated as duplicates.
+    """
+    segments = map_segments(_parse_segment, filename, jobs, for_sale, region=FRAME_REGION)
+
+    if len(segments) > 1:
+        # Each segment only checked the scrolling within itself, check it across segments too.
+        scroll_positions = [position for segment in segments for position in segment.scroll_positions]
+        scroll_runs = itertools.groupby(scroll_positions, key=lambda position: position is None)
+        if any(_is_inconsistent_scroll([p for p in run if p is not None]) for _, run in scroll_runs):
+            raise AssertionError("Video is scrolling inconsistently.")
+
+    # Pick the phase of each segment that continues the catalog frames of the segments before it.
+    pages: list[tuple[FRAME_TYPE, int]] = []
+    catalog_frames = 0
+    for segment in segments:
+        pages.append(segment.pages[(catalog_frames - segment.warmup_frames) % len(segment.pages)])
+        catalog_frames += segment.catalog_frames
+
+    all_rows = pages[0][0] if len(pages) == 1 else np.concatenate([rows for rows, _ in pages])
+    item_scroll_count = sum(count for _, count in pages)
+    assert item_scroll_count < 20, "Video is scrolling too slowly."
+    assert len(all_rows), "No items found, invalid video?"
+
+    # Concatenate all rows into a single image.
+    with stage("dedupe"):
+        return _dedupe_rows(all_rows, max_distance)
+
+
+@dataclasses.dataclass
+class _Segment:
+    """Item rows found in a segment of a video, see `_parse_segment`."""
+
+    pages: list[tuple[FRAME_TYPE, int]]  # Item rows and item scroll count, for each phase.
+    warmup_frames: int  # Catalog frames decoded before the first frame of the segment.
+    catalog_frames: int  # Catalog frames from the first frame of the segment on.
+    scroll_positions: list[Optional[int]]  # See `_read_frames`.
+
+
+def _parse_segment(filename: Path | FrameSource, first: int, for_sale: bool) -> _Segment:
+    """Parses the frames of a video (segment) from frame `first` on.
+
+    Which catalog frames are parsed depends on the number of catalog frames
+    before the segment, which only the segments before it know. So segments
+    after the first one are parsed for each of the 3 phases and `parse_video`
+    picks one. Pages before the first frame only tell which rows were seen last.
+    """
+    readers = [_PageReader(RowArena(), phase) for phase in range(3 if first else 1)]
+    skipped = [(0, 0)] * len(readers)  # Rows and item scroll count before the first frame.
+    scroll_log: list[tuple[int, Optional[int]]] = []
+    frame_counts = [0, 0]  # Catalog frames before and from the first frame on.
+    for index, frame in _read_frames(filename, scroll_log):
+        frame_counts[index >= first] += 1
+        new_rows = _parse_rows(frame, for_sale) if any(reader.wants() for reader in readers) else None
+        for phase, reader in enumerate(readers):
+            if reader.add(new_rows if reader.wants() else None) and index < first:
+                skipped[phase] = len(reader.all_rows), reader.item_scroll_count
+
+    return _Segment(
+        pages=[
+            (reader.all_rows.rows[rows:], reader.item_scroll_count - item_scroll_count)
+            for reader, (rows, item_scroll_count) in zip(readers, skipped)
+        ],
+        warmup_frames=frame_counts[0],
+        catalog_frames=frame_counts[1],
+        scroll_positions=[position for index, position in scroll_log if index >= first],
+    )
+
+
+def _parse_frames(filename: Path | FrameSource, for_sale: bool, all_rows: RowArena) -> Iterator[int]:
+    """Parses the frames of a video into `all_rows`, yields the item scroll count after each new page."""
+    reader = _PageReader(all_rows)
+    for _, frame in _read_frames(filename):
+        if reader.add(_parse_rows(frame, for_sale) if reader.wants() else None):
+            # Exit if video is not properly page scrolling.
+            assert reader.item_scroll_count < 20, "Video is scrolling too slowly."
+            yield reader.item_scroll_count
+
+
+class _PageReader:
+    """Adds the item rows of each new page of a catalog video to `all_rows`.
+
+    Only every third catalog frame is parsed (3 frames per page), `phase` is
+    the number of catalog frames before the first one added, modulo 3.
+    """
+
+    def __init__(self, all_rows: RowArena, phase: int = 0) -> None:
+        self.all_rows = all_rows
+        self.item_scroll_count = 0
+        self._frame_count = phase
+        self._unfinished_page = False
+
+    def wants(self) -> bool:
+        """Checks whether the next catalog frame has to be parsed."""
+        return self._unfinished_page or self._frame_count % 3 == 0
+
+    def add(self, new_rows: Optional[list[FRAME_TYPE]]) -> bool:
+        """Adds the rows of the next catalog frame, None if it is not parsed. Returns whether it was a new page."""
+        self._frame_count += 1
+        if new_rows is None or _is_duplicate_rows(self.all_rows, new_rows):
+            return False  # Skip non-moving frames
 
         # There's an issue in Switch's font rendering where it struggles to
         # keep up with page scrolling, leading to bottom rows sometimes being empty.
         # Since we parse every third frame, this can lead to items getting missed.
         # The fix is to search for empty rows and force a scan of the next frame.
-        unfinished_page = any(r.min() > 150 for r in new_rows)
+        self._unfinished_page = any(r.min() > 150 for r in new_rows)
+
+        self.item_scroll_count += _is_item_scroll(self.all_rows, new_rows)
+        self.all_rows.extend(new_rows)
+        return True
 
-        # Exit if video is not properly page scrolling.
-        item_scroll_count += _is_item_scroll(all_rows, new_rows)
-        assert item_scroll_count < 20, "Video is scrolling too slowly."
-        all_rows.extend(new_rows)
 
-    assert all_rows, "No items found, invalid video?"
+def run_ocr(
+    item_rows: ROWS_TYPE, lang: str = "eng", workers: Optional[int] = None, cache: Optional[RowTextCache] = None
+) -> set[str]:
+    """Runs tesseract OCR on images of item names and returns all items found.
 
-    # Concatenate all rows into a single image.
-    return _dedupe_rows(all_rows)
+    Large catalogs are split into chunks that are recognized concurrently by `workers` threads.
+    Rows are binarized and trimmed first, see `ocr.compact_rows`. With a `cache`, only rows whose text is not cached
+    yet are recognized.
+    """
+    if cache is not None:
+        return _run_cached_ocr(item_rows, lang, workers, cache)
 
+    texts = ocr.image_rows_to_strings(
+        item_rows, lang, variables=_get_tesseract_variables(lang), workers=workers, compact=True
+    )
 
-def run_ocr(item_rows: list[FRAME_TYPE], lang: str = "eng") -> set[str]:
-    """Runs tesseract OCR on an image of item names and returns all items found."""
-    if not item_rows:
-        return set()  # Recursive base case.
+    # Split the results of all chunks in order and remove empty lines.
+    return {_cleanup_name(item, lang) for text in texts for item in text.split("\n")} - {""}
 
-    # For larger catalogs, recursively split scans to avoid Tesseract's 32k limit.
-    # Each row is 35px high; 900 x 35 = 31.5k which is below the limit.
-    item_rows, remaining_rows = item_rows[:900], item_rows[900:]
 
-    logging.debug("Running Tesseract on %s rows", len(item_rows))
-    parsed_text = pytesseract.image_to_string(
-        Image.fromarray(cv2.vconcat(item_rows)), lang=lang, config=_get_tesseract_config(lang)
-    )
-    assert isinstance(parsed_text, str), "Tesseract returned bytes"
+def _run_cached_ocr(item_rows: ROWS_TYPE, lang: str, workers: Optional[int], cache: RowTextCache) -> set[str]:
+    """Runs OCR row by row, looking up and storing the text of each row in the cache."""
+    rows = {_row_hash(row): row for row in item_rows}
+    texts = cache.get_many(list(rows), lang)
+    missing = [row_hash for row_hash in rows if row_hash not in texts]
+    count("ocr_cache_hits", len(rows) - len(missing))
+    count("ocr_cache_misses", len(missing))
 
-    # Split the results and remove empty lines.
-    clean_names = {_cleanup_name(item, lang) for item in parsed_text.split("\n")}
+    if missing:
+        variables = _get_tesseract_variables(lang)
+        row_texts = ocr.image_rows_to_row_strings(
+            [rows[h] for h in missing], lang, variables=variables, workers=workers, compact=True
+        )
+        new_texts = {row_hash: _cleanup_name(text, lang) for row_hash, text in zip(missing, row_texts)}
+        cache.put_many(new_texts, lang)
+        texts.update(new_texts)
 
-    # Add recursive results and remove empty lines.
-    remaining_names = run_ocr(remaining_rows, lang)
-    return (clean_names | remaining_names) - {""}
+    return set(texts.values()) - {""}
 
 
 def match_items(item_names: set[str], locale: str = "en-us") -> tuple[list[str], list[str]]:
     """Matches a list of names against a database of items, finding best matches."""
     no_match_items = []
     matched_items = set()
-    item_db = _get_item_db(locale)
     for item in sorted(item_names):
-        if item in item_db:
-            # If item name exists is in the DB, add it as is
-            matched_items.add(item)
-            continue
-
-        # Otherwise, try to find closest name in the DB with a cutoff.
-        matches = difflib.get_close_matches(item, item_db, n=1, cutoff=0.5)
-        if not matches:
+        match = _match_item(item, locale)
+        if match is None:
             no_match_items.append(item)
             assert len(no_match_items) <= 0.3 * len(item_names), "Failed to match multiple items, wrong language?"
             continue
-
-        # Calculate difference ratio for better logging
-        ratio = difflib.SequenceMatcher(None, item, matches[0]).ratio()
-        logging.debug("Matched %r to %r (%.2f)", item, matches[0], ratio)
-
-        matched_items.add(matches[0])
+        matched_items.add(match)
 
     if no_match_items:
         logging.warning("Failed to match %d items: %s", len(no_match_items), no_match_items)
@@ -165,32 +468,71 @@ def match_items(item_names: set[str], locale: str = "en-us") -> tuple[list[str],
     return sorted(matched_items), no_match_items
 
 
-def _read_frames(filename: Path) -> Iterator[FRAME_TYPE]:
-    """Parses frames of the given video and returns the relevant region in grayscale."""
+def _match_item(item: str, locale: str) -> Optional[str]:
+    """Returns the item of the database matching the name, None if no item is close enough."""
+    item_index = _get_item_index()
+    if item_index.contains(item, locale):
+        # If item name exists is in the DB, add it as is
+        count("matches_fast")
+        return item
+
+    # Otherwise, try to find closest name in the DB with a cutoff.
+    count("matches_slow")
+    match = item_index.best_match(item, locale, cutoff=0.5)
+    if match is None:
+        return None
+
+    logging.debug("Matched %r to %r (%.2f)", item, *match)
+    return match[0]
+
+
+def _read_frames(
+    filename: Path | FrameSource, scroll_log: Optional[list[tuple[int, Optional[int]]]] = None
+) -> Iterator[tuple[int, FRAME_TYPE]]:
+    """Parses frames of the given video and returns the index and relevant region of each.
+
+    Only the `FRAME_REGION` of the frames is looked at, a video opened here is
+    cropped to it by the decoder. Every frame is needed to follow the scrollbar,
+    but only the small scrollbar region gets converted to grayscale here. The
+    caller converts the returned region of the frames it actually parses. The
+    index and scrollbar position of every frame are appended to `scroll_log`,
+    None where the item list is not visible.
+    """
     scroll_positions: list[int] = []
-    cap = cv2.VideoCapture(filename)  # type: ignore[call-overload]
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # Video is over
-
-        assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
-
-        if not detect(frame):
-            scroll_positions = []  # Reset scroll positions on catalog change.
-            continue  # Skip frames where item list is not visible.
-
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        # Crop scrollbar region and get scroll position, then warn about bad scrolling.
-        scrollbar = gray[160:570, 1235:1245].mean(axis=1)
-        scroll_positions.append(np.argmax(scrollbar < 150))  # type: ignore[arg-type]
-        if _is_inconsistent_scroll(scroll_positions):
-            raise AssertionError("Video is scrolling inconsistently.")
-
-        # Crop the region containing item name and price.
-        yield gray[150:630, 635:1220]
-    cap.release()
+    sampler = FrameSampler()
+    with open_frames(filename, FRAME_REGION) as frames:
+        if frames.region is not None:
+            # Cropped frames don't tell the resolution of the video, its headers do.
+            height, width = probe_resolution(frames.filename)
+            assert (height, width) == (720, 1280), "Invalid resolution: {}x{}".format(width, height)
+
+        for frame in frames.sample(sampler):
+            if frames.region is None:
+                assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
+            frame = crop_frame(frames, frame, FRAME_REGION)
+
+            if not _detect_region(frame):
+                scroll_positions = []  # Reset scroll positions on catalog change.
+                if scroll_log is not None:
+                    scroll_log.append((sampler.position, None))
+                continue  # Skip frames where item list is not visible.
+
+            # Crop scrollbar region and get scroll position, then warn about bad scrolling.
+            scrollbar = cv2.cvtColor(frame[10:420, 601:611], cv2.COLOR_BGR2GRAY).mean(axis=1)
+            scroll_positions.append(int(np.argmax(scrollbar < 150)))
+            if scroll_log is not None:
+                scroll_log.append((sampler.position, scroll_positions[-1]))
+            if _is_inconsistent_scroll(scroll_positions):
+                raise AssertionError("Video is scrolling inconsistently.")
+
+            # Crop the region containing item name and price.
+            yield sampler.position, frame[:, 1:586]
+
+
+def _parse_rows(frame: FRAME_TYPE, for_sale: bool) -> list[FRAME_TYPE]:
+    """Converts the region of a frame returned by `_read_frames` to grayscale and extracts its item rows."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return list(_parse_frame(gray, for_sale))
 
 
 def _parse_frame(frame: FRAME_TYPE, for_sale: bool) -> Iterator[FRAME_TYPE]:
@@ -223,19 +565,19 @@ def _parse_frame(frame: FRAME_TYPE, for_sale: bool) -> Iterator[FRAME_TYPE]:
         yield row[:, :415]  # Return the name region
 
 
-def _is_duplicate_rows(all_rows: list[FRAME_TYPE], new_rows: list[FRAME_TYPE]) -> bool:
+def _is_duplicate_rows(all_rows: RowArena, new_rows: list[FRAME_TYPE]) -> bool:
     """Checks if the new set of rows are the same as the previous seen rows."""
     if not len(all_rows) > len(new_rows) > 4:
         return False
 
     # Check a few middle rows to avoid the hovered row.
-    old_concat = cv2.vconcat(all_rows[-5:-2])
+    old_concat = all_rows[-5:-2].reshape(-1, ROW_SHAPE[1])
     new_concat = cv2.vconcat(new_rows[-5:-2])
     diff = cv2.absdiff(old_concat, new_concat)
     return diff.mean() < 4  # type: ignore[no-any-return]
 
 
-def _is_item_scroll(all_rows: list[FRAME_TYPE], new_rows: list[FRAME_TYPE]) -> bool:
+def _is_item_scroll(all_rows: RowArena, new_rows: list[FRAME_TYPE]) -> bool:
     """Checks whether the video is item scrolling instead of page scrolling."""
     if len(all_rows) < 3 or len(new_rows) < 3:
         return False
@@ -256,38 +598,52 @@ def _is_inconsistent_scroll(scroll_positions: list[int]) -> bool:
     return downscroll_count > 10 and upscroll_count > 10
 
 
-def _dedupe_rows(all_rows: list[FRAME_TYPE]) -> list[FRAME_TYPE]:
-    """Dedupe rows by using image hashing and remove blank rows."""
-    row_set: set[str] = set()
-    deduped_rows: list[FRAME_TYPE] = []
-    for row in all_rows:
-        if row.min() > 150:
-            continue  # Blank row
-        row_hash = str(cv2.img_hash.blockMeanHash(row, mode=1)[0])
-        if row_hash in row_set:
-            continue  # Row already seen
-        row_set.add(row_hash)
-        deduped_rows.append(row)
-    return deduped_rows
-
-
-def _get_tesseract_config(lang: str) -> str:
-    """Generates Tesseract configurations for the given language."""
-    configs = [
-        "--psm 6"  # Manually specify that we know orientation / shape.
-        "-c preserve_interword_spaces=1",  # Fixes spacing between logograms.
-        "-c tessedit_do_invert=0",  # Speed up skipping invert check.
-    ]
+def _dedupe_rows(all_rows: FRAME_TYPE, max_distance: int = DEDUPE_MAX_DISTANCE) -> FRAME_TYPE:
+    """Dedupe rows by using image hashing and remove blank rows.
+
+    A row is dropped if its hash is within `max_distance` bits of a row kept before it.
+    """
+    return RowDeduper(max_distance).dedupe(all_rows)
+
+
+def _row_hashes(rows: FRAME_TYPE) -> np.ndarray:
+    """Computes the hashes of a stack of rows, as an array of shape (N, 10) of packed uint64 bits.
+
+    Each bit tells whether a block of the `ROW_HASH_GRID` is darker than the row on average.
+    """
+    grid_y, grid_x = ROW_HASH_GRID
+    y_edges = np.linspace(0, rows.shape[1], grid_y + 1).astype(int)
+    x_edges = np.linspace(0, rows.shape[2], grid_x + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(rows, y_edges[:-1], axis=1, dtype=np.int32), x_edges[:-1], axis=2)
+    means = sums / np.outer(np.diff(y_edges), np.diff(x_edges))
+    bits = means < means.mean(axis=(1, 2), keepdims=True)
+    return np.packbits(bits.reshape(len(rows), grid_y * grid_x), axis=1).view(np.uint64)
+
+
+def _row_hash(row: FRAME_TYPE) -> str:
+    """Computes a perceptual hash of an item row, identical rows have the same hash."""
+    return cv2.img_hash.blockMeanHash(row, mode=1)[0].tobytes().hex()  # type: ignore[no-any-return]
+
+
+def _get_tesseract_variables(lang: str) -> dict[str, str]:
+    """Generates Tesseract configuration variables for the given language.
+
+    The page segmentation mode is always `ocr.PSM_SINGLE_BLOCK`, as we know the orientation / shape.
+    """
+    variables = {
+        "preserve_interword_spaces": "1",  # Fixes spacing between logograms.
+        "tessedit_do_invert": "0",  # Speed up skipping invert check.
+    }
     if lang in ["jpn", "chi_sim", "chi_tra"]:
         # Parameters specific to parsing logograms.
-        configs.extend(
-            [
-                "-c language_model_ngram_on=0",
-                "-c textord_force_make_prop_words=F",
-                "-c edges_max_children_per_outline=40",
-            ]
+        variables.update(
+            {
+                "language_model_ngram_on": "0",
+                "textord_force_make_prop_words": "F",
+                "edges_max_children_per_outline": "40",
+            }
         )
-    return " ".join(configs)
+    return variables
 
 
 def _cleanup_name(item_name: str, lang: str) -> str:
@@ -314,43 +670,130 @@ def _get_item_db(locale: str) -> set[str]:
     return set(read_json_asset(ITEMS_PATH / f"{locale}.json"))
 
 
-def _detect_locale(item_rows: list[FRAME_TYPE], locale: str) -> str:
-    """Detects the right locale for the given items if required."""
-    if locale != "auto":
-        # If locale is already specified, return as is.
-        return locale
-
-    # Sample a subset of the rows and convert to Pillow image.
-    if len(item_rows) > 300:
-        item_rows = random.sample(item_rows, 300)
-    image = Image.fromarray(cv2.vconcat(item_rows))
-
+@functools.lru_cache(maxsize=None)
+def _get_item_index() -> ItemIndex:
+    """Loads the index over the item names of all locales, with caching.
+
+    Falls back to building it from the item databases if the index file is missing or older than them,
+    and writes it for the next processes.
+    """
+    locales = [locale for locale in LOCALE_MAP if locale != "auto"]
+    if ITEM_INDEX_PATH.exists():
+        index_mtime = ITEM_INDEX_PATH.stat().st_mtime
+        if all((ITEMS_PATH / f"{locale}.json").stat().st_mtime <= index_mtime for locale in locales):
+            return ItemIndex.load(ITEM_INDEX_PATH)
+        logging.info("Item index is outdated, rebuilding it")
+
+    index = _build_item_index()
+    # Written to a file of its own first, so processes building it at once never load a partial index.
+    temp_path = ITEM_INDEX_PATH.with_name(f"{ITEM_INDEX_PATH.name}.{os.getpid()}")
     try:
-        osd_data = typing.cast(dict[str, str], pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT))
-    except pytesseract.TesseractError:
-        return "en-us"
+        index.save(temp_path)
+        temp_path.replace(ITEM_INDEX_PATH)
+    except OSError as e:
+        logging.warning("Failed to write the item index: %s", e)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return index
+
 
-    possible_locales = SCRIPT_MAP.get(osd_data["script"])
-    assert possible_locales, "Failed to automatically detect language."
+def _build_item_index() -> ItemIndex:
+    """Builds the index over the item names of all locales from the item databases."""
+    return ItemIndex.build({locale: _get_item_db(locale) for locale in LOCALE_MAP if locale != "auto"})
 
-    # If we can uniquely guess the language from the script, use that.
-    if len(possible_locales) == 1:
-        logging.info("Detected locale: %s", possible_locales[0])
-        return possible_locales[0]
 
-    # Otherwise, run OCR on the first few items and try to find the best matching locale.
-    if len(item_rows) > 30:
-        item_rows = random.sample(item_rows, 30)
-    item_names = run_ocr(item_rows, lang="script/Latin")
+def _detect_locale(item_rows: FRAME_TYPE, locale: str) -> tuple[str, dict[int, str]]:
+    """Detects the right locale for the given items if required.
 
-    def match_score_func(locale: str) -> int:
-        """Computes how many items match for a given locale."""
-        item_db = _get_item_db(locale)
-        return sum(name in item_db for name in item_names)
+    Returns the locale and the names of the sampled rows that are items of it, by row index.
+    """
+    if locale != "auto":
+        # If locale is already specified, return as is.
+        return locale, {}
+
+    # OCR a sample of the rows as Latin text and look up which locales the names belong to.
+    sample = sorted(random.sample(range(len(item_rows)), min(len(item_rows), LOCALE_SAMPLE_SIZE)))
+    names = _ocr_sample(item_rows, sample, LATIN_LANG)
+    hits = _count_locale_hits(names.values())
+    latin_locale = max(SCRIPT_MAP["Latin"], key=lambda locale: hits[locale])
+    if hits[latin_locale] >= MIN_LATIN_HITS * len(sample):
+        logging.info("Detected locale: %s", latin_locale)
+        return latin_locale, _known_names(names, latin_locale)
+
+    # Otherwise the names are in another script. Each of a few rows votes for its script, read with the slow
+    # languages of all other scripts.
+    script_names = _ocr_sample(item_rows, sample[:SCRIPT_SAMPLE_SIZE], NON_LATIN_LANG)
+    votes = collections.Counter(filter(None, map(_classify_script, script_names.values())))
+    if not votes:
+        logging.info("No known script detected, falling back to: %s", latin_locale)
+        return latin_locale, {}
+
+    script, script_votes = votes.most_common(1)[0]
+    if script_votes * 2 <= votes.total():
+        # The rows disagree, try the locales of all other scripts.
+        possible_locales = [locale for name, locales in SCRIPT_MAP.items() if name != "Latin" for locale in locales]
+    elif script == "Han":
+        # Kanji are shared by Japanese and Chinese, which the item names tell apart.
+        possible_locales = SCRIPT_MAP["HanS"] + SCRIPT_MAP["HanT"]
+    else:
+        possible_locales = SCRIPT_MAP[script]
+
+    # Then OCR the sample with the language of each possible locale and look up which locales the names belong to.
+    best_locale, best_names = possible_locales[0], {}
+    best_hits = -1
+    for lang in dict.fromkeys(LOCALE_MAP[locale] for locale in possible_locales):
+        names = _ocr_sample(item_rows, sample, lang)
+        hits = _count_locale_hits(names.values())
+        lang_locale = max(possible_locales, key=lambda locale: hits[locale])
+        if hits[lang_locale] > best_hits:
+            best_locale, best_names, best_hits = lang_locale, names, hits[lang_locale]
 
-    best_locale = max(possible_locales, key=match_score_func)
     logging.info("Detected locale: %s", best_locale)
-    return best_locale
+    return best_locale, _known_names(best_names, best_locale)
+
+
+def _ocr_sample(item_rows: FRAME_TYPE, sample: list[int], lang: str) -> dict[int, str]:
+    """Runs OCR on the sampled rows and returns the text of each, by row index."""
+    texts = ocr.image_rows_to_row_strings(
+        [item_rows[i] for i in sample], lang, variables=_get_tesseract_variables(lang), compact=True
+    )
+    return {i: _cleanup_name(text, lang) for i, text in zip(sample, texts)}
+
+
+def _count_locale_hits(names: Iterable[str]) -> collections.Counter[str]:
+    """Counts for every locale how many of the names are items of it."""
+    item_index = _get_item_index()
+    hits: collections.Counter[str] = collections.Counter()
+    for name in names:
+        mask = item_index.locale_mask(name)
+        hits.update(locale for bit, locale in enumerate(item_index.locales) if mask >> bit & 1)
+    return hits
+
+
+def _known_names(names: dict[int, str], locale: str) -> dict[int, str]:
+    """Filters the OCR'd names of rows down to the items of the locale."""
+    item_index = _get_item_index()
+    return {i: name for i, name in names.items() if item_index.contains(name, locale)}
+
+
+def _classify_script(text: str) -> Optional[str]:
+    """Returns the most frequent non-Latin script of the characters of a text, None if there is none."""
+    scripts: collections.Counter[str] = collections.Counter()
+    for char in text:
+        name = unicodedata.name(char, "")
+        if name.startswith(("HIRAGANA", "KATAKANA")):
+            scripts["Japanese"] += 1
+        elif name.startswith("HANGUL"):
+            scripts["Hangul"] += 1
+        elif name.startswith("CYRILLIC"):
+            scripts["Cyrillic"] += 1
+        elif name.startswith("CJK"):
+            scripts["Han"] += 1
+
+    # Japanese names mix kana and kanji, so any kana is a strong hint.
+    if scripts["Japanese"] and scripts["Japanese"] * 5 >= scripts["Han"]:
+        return "Japanese"
+    return scripts.most_common(1)[0][0] if scripts else None
 
 
 if __name__ == "__main__":
@@ -3,17 +3,24 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 # Copyright (c) 2024 Nachtalb
 # This file contains both MIT and LGPL-3.0-or-later licensed code.
+import contextlib
+import contextvars
 import dataclasses
 import enum
 import json
+import os
+import threading
+import time
 from pathlib import Path
-from typing import Any, List
+from typing import Any, Dict, Iterator, List
 
+import cv2
 import numpy as np
 
 ASSET_PATH = Path(__file__).parent.parent / "assets"
 
 FRAME_TYPE = np.ndarray[Any, np.dtype[np.integer[Any] | np.floating[Any]]]
+ROWS_TYPE = list[FRAME_TYPE] | FRAME_TYPE  # A list of images or a stacked array of images of the same size.
 NP_BOOL = np.dtype(np.bool)
 
 
@@ -26,12 +33,113 @@ class ScanMode(enum.Enum):
     MUSIC = 6
 
 
+# Mapping supported AC:NH locales to tesseract languages, kept here so the CLI lists them without importing catalog.
+LOCALE_MAP: dict[str, str] = {
+    "auto": "auto",  # Automatic detection
+    "de-eu": "deu",
+    "en-eu": "eng",
+    "en-us": "eng",
+    "es-eu": "spa",
+    "es-us": "spa",
+    "fr-eu": "fra",
+    "fr-us": "fra",
+    "it-eu": "ita",
+    "ja-jp": "jpn",
+    "ko-kr": "kor",
+    "nl-eu": "nld",
+    "ru-eu": "rus",
+    "zh-cn": "chi_sim",
+    "zh-tw": "chi_tra",
+}
+
+
+# Stats are recorded from the decoder and OCR threads as well.
+_stats_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class ScanStats:
+    """Wall and CPU seconds per stage and counters collected while scanning.
+
+    CPU time is the time of the thread running the stage, decoding runs on its
+    own thread and is reported as the "decode" stage.
+    """
+
+    timings: Dict[str, Dict[str, float]] = dataclasses.field(default_factory=dict)
+    counters: Dict[str, int] = dataclasses.field(default_factory=dict)
+
+    def add_time(self, stage: str, wall: float, cpu: float) -> None:
+        with _stats_lock:
+            timing = self.timings.setdefault(stage, {"wall": 0.0, "cpu": 0.0})
+            timing["wall"] += wall
+            timing["cpu"] += cpu
+
+    def count(self, counter: str, value: int = 1) -> None:
+        with _stats_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def merge(self, other: "ScanStats") -> None:
+        """Adds the stats of another scan, e.g. one of a video segment scanned in another process."""
+        for stage, timing in other.timings.items():
+            self.add_time(stage, timing["wall"], timing["cpu"])
+        for counter, value in other.counters.items():
+            self.count(counter, value)
+
+    def to_json(self) -> Dict[str, Any]:
+        timings = {
+            stage: {key: round(value, 4) for key, value in timing.items()} for stage, timing in self.timings.items()
+        }
+        return {"timings": timings, "counters": self.counters}
+
+    def format(self) -> str:
+        """Formats the stats as a table for printing."""
+        lines = [f"{'Stage':<16}{'Wall':>10}{'CPU':>10}"]
+        lines += [f"{stage:<16}{t['wall']:>9.3f}s{t['cpu']:>9.3f}s" for stage, t in self.timings.items()]
+        lines += [f"{counter:<16}{value:>10}" for counter, value in self.counters.items()]
+        return "\n".join(lines)
+
+
+_current_stats: contextvars.ContextVar[ScanStats] = contextvars.ContextVar("scan_stats")
+
+
+@contextlib.contextmanager
+def collect_stats() -> Iterator[ScanStats]:
+    """Collects the stats recorded with `stage` and `count` within the block."""
+    stats = ScanStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def current_stats() -> ScanStats:
+    """Returns the stats of the running scan, or a throwaway instance if none are collected."""
+    return _current_stats.get(ScanStats())
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Records the wall and CPU time spent in the block for the running scan."""
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        current_stats().add_time(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+
+def count(counter: str, value: int = 1) -> None:
+    """Increments a counter of the running scan."""
+    current_stats().count(counter, value)
+
+
 @dataclasses.dataclass
 class ScanResult:
     mode: ScanMode
     items: List[str]
     locale: str
     unmatched: List[str] = dataclasses.field(default_factory=list)
+    stats: ScanStats = dataclasses.field(default_factory=ScanStats, compare=False, repr=False)
 
 
 def read_asset(filename: str | Path, encoding: str = "utf-8") -> str:
@@ -43,3 +151,29 @@ def read_asset(filename: str | Path, encoding: str = "utf-8") -> str:
 
 def read_json_asset(filename: str | Path, encoding: str = "utf-8") -> Any:
     return json.loads(read_asset(filename, encoding=encoding))
+
+
+def read_image_pack(directory: Path, filenames: List[str]) -> np.ndarray:
+    """Reads the images of `directory / "generated"` stacked into one array.
+
+    The pack written by `write_image_pack` is memory-mapped if it holds the same images and is newer
+    than them, so processes share its pages, otherwise the images are decoded one by one.
+    """
+    pack_path, metadata_path = directory / "images.npy", directory / "images.json"
+    if pack_path.exists() and metadata_path.exists() and read_json_asset(metadata_path) == filenames:
+        pack_mtime = pack_path.stat().st_mtime
+        if all((directory / "generated" / name).stat().st_mtime <= pack_mtime for name in filenames):
+            return np.load(pack_path, mmap_mode="r")  # type: ignore[no-any-return]
+    return np.stack([cv2.imread(str(directory / "generated" / name)) for name in filenames])  # type: ignore[misc]
+
+
+def write_image_pack(directory: Path, filenames: List[str]) -> None:
+    """Decodes the images of `directory / "generated"` into a pack for `read_image_pack`."""
+    images = np.stack([cv2.imread(str(directory / "generated" / name)) for name in filenames])  # type: ignore[misc]
+
+    # Scans may be reading the old pack, so replace the files instead of writing over them.
+    with open(directory / "images.tmp.npy", "wb") as file:
+        np.save(file, images)
+    (directory / "images.tmp.json").write_text(json.dumps(filenames), encoding="utf-8")
+    os.replace(directory / "images.tmp.npy", directory / "images.npy")
+    os.replace(directory / "images.tmp.json", directory / "images.json")
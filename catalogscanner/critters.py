@@ -8,18 +8,35 @@ import enum
 import functools
 import itertools
 from pathlib import Path
-from typing import Dict, Iterator, List, Tuple
+from typing import Dict, Iterator, List, Set, Tuple
 
 import cv2
 import numpy as np
 
-from catalogscanner.common import ASSET_PATH, FRAME_TYPE, ScanMode, ScanResult, read_json_asset
+from catalogscanner.common import (
+    ASSET_PATH,
+    FRAME_TYPE,
+    ScanMode,
+    ScanResult,
+    count,
+    read_image_pack,
+    read_json_asset,
+    stage,
+)
+from catalogscanner.frames import FrameSampler, FrameSource, open_frames
+from catalogscanner.matching import ImageMatcher
 
 # The expected color for the video background.
 BG_COLOR = np.array([207, 238, 240])
 
 CRITTERS_PATH = ASSET_PATH / "critters"
 
+# Horizontal shifts of the icons tried when the closest critters are too similar.
+MATCH_SHIFTS = (-2, -1, 0, 1, 2)
+
+# Difference in mean pixel distance of the two closest critters to trust the closest.
+MATCH_MARGIN = 3
+
 
 class CritterType(enum.Enum):
     INSECTS = 1
@@ -35,9 +52,8 @@ class CritterType(enum.Enum):
 class CritterImage:
     """The image and data associated with a critter icon."""
 
-    def __init__(self, critter_name: str, critter_type: CritterType, icon_name: str) -> None:
-        img_path = CRITTERS_PATH / "generated" / icon_name
-        self.img = cv2.imread(str(img_path))
+    def __init__(self, critter_name: str, critter_type: CritterType, icon_name: str, img: FRAME_TYPE) -> None:
+        self.img = img
         self.critter_name = critter_name
         self.critter_type = critter_type
         self.icon_name = icon_name
@@ -58,10 +74,13 @@ def detect(frame: FRAME_TYPE) -> bool:
     return np.linalg.norm(color - BG_COLOR) < 5  # type: ignore[return-value]
 
 
-def scan(video_file: Path, locale: str = "en-us") -> ScanResult:
+def scan(video_file: Path | FrameSource, locale: str = "en-us") -> ScanResult:
     """Scans a video of scrolling through Critterpedia and returns all critters found."""
-    critter_icons = parse_video(video_file)
-    critter_names = match_critters(critter_icons)
+    with stage("parse"):
+        critter_icons = parse_video(video_file)
+    count("icons", len(critter_icons))
+    with stage("match"):
+        critter_names = match_critters(critter_icons)
     results = translate_names(critter_names, locale)
 
     return ScanResult(
@@ -71,7 +90,7 @@ def scan(video_file: Path, locale: str = "en-us") -> ScanResult:
     )
 
 
-def parse_video(filename: Path) -> List[CritterIcon]:
+def parse_video(filename: Path | FrameSource) -> List[CritterIcon]:
     """Parses a whole video and returns icons for all critters found."""
     all_icons: List[CritterIcon] = []
     section_count: Dict[CritterType, int] = collections.defaultdict(int)
@@ -90,11 +109,14 @@ def parse_video(filename: Path) -> List[CritterIcon]:
 
 def match_critters(critter_icons: List[CritterIcon]) -> List[str]:
     """Matches icons against database of critter images, finding best matches."""
-    matched_critters = set()
+    matched_critters: Set[str] = set()
     critter_db = _get_critter_db()
-    for icon in critter_icons:
-        best_match = _find_best_match(icon, critter_db[icon.critter_type])
-        matched_critters.add(best_match.critter_name)
+    for critter_type in CritterType:
+        icons = [icon for icon in critter_icons if icon.critter_type == critter_type]
+        if not icons:
+            continue
+        best_matches = _find_best_matches(np.stack(icons), _get_critter_matcher(critter_type))
+        matched_critters.update(critter_db[critter_type][i].critter_name for i in best_matches)
     return sorted(matched_critters)
 
 
@@ -107,62 +129,52 @@ def translate_names(critter_names: List[str], locale: str) -> List[str]:
     return [translations[name][locale] for name in critter_names]
 
 
-def _read_frames(filename: Path) -> Iterator[Tuple[CritterType, FRAME_TYPE]]:
+def _read_frames(filename: Path | FrameSource) -> Iterator[Tuple[CritterType, FRAME_TYPE]]:
     """Parses frames of the given video and returns the relevant region."""
-    frame_skip = 0
     last_section = None
     last_frame = None
 
     good_frames: Dict[Tuple[CritterType, int], FRAME_TYPE] = {}
 
-    cap = cv2.VideoCapture(filename)  # type: ignore[call-overload]
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # Video is over
-
-        if frame_skip > 0:
-            frame_skip -= 1
-            continue
-
-        if frame.shape[:2] == (1080, 1920):
-            frame = cv2.resize(frame, (1280, 720))
-
-        assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
+    sampler = FrameSampler()
+    with open_frames(filename) as frames:
+        for frame in frames.sample(sampler):
+            if frame.shape[:2] == (1080, 1920):
+                frame = cv2.resize(frame, (1280, 720))
 
-        if not detect(frame):
-            continue  # Skip frames that are not showing critterpedia.
+            assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
 
-        # Detect a dark line that shows up only in Pictures Mode.
-        mode_detector = frame[20:24, 600:800].mean(axis=(0, 1))
-        if np.linalg.norm(mode_detector - (199, 234, 237)) > 50:
-            raise AssertionError("Critterpedia is in Pictures Mode.")
+            if not detect(frame):
+                continue  # Skip frames that are not showing critterpedia.
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        if filename.suffix == ".jpg":  # Handle screenshots
-            yield _detect_critter_section(gray), frame[149:623, :]
-            continue
+            # Detect a dark line that shows up only in Pictures Mode.
+            mode_detector = frame[20:24, 600:800].mean(axis=(0, 1))
+            if np.linalg.norm(mode_detector - (199, 234, 237)) > 50:
+                raise AssertionError("Critterpedia is in Pictures Mode.")
 
-        if last_frame is None:
-            last_frame = frame
-            continue
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if frames.filename.suffix == ".jpg":  # Handle screenshots
+                yield _detect_critter_section(gray), frame[149:623, :]
+                continue
 
-        critter_section = _detect_critter_section(gray)
-        if critter_section != last_section:
-            if last_section is not None:
-                frame_skip = 15
-            last_section = critter_section
-            continue
+            if last_frame is None:
+                last_frame = frame
+                continue
 
-        # Grab the last frame for each side and section combination.
-        if last_frame[570:600, :70, 2].min() > 230:
-            good_frames[critter_section, 0] = last_frame
-        elif last_frame[570:600, -70:, 2].min() > 230:
-            good_frames[critter_section, 1] = last_frame
+            critter_section = _detect_critter_section(gray)
+            if critter_section != last_section:
+                if last_section is not None:
+                    sampler.skip(15)  # Skip the section change animation.
+                last_section = critter_section
+                continue
 
-        last_frame = frame
+            # Grab the last frame for each side and section combination.
+            if last_frame[570:600, :70, 2].min() > 230:
+                good_frames[critter_section, 0] = last_frame
+            elif last_frame[570:600, -70:, 2].min() > 230:
+                good_frames[critter_section, 1] = last_frame
 
-    cap.release()
+            last_frame = frame
 
     for (critter_type, _), frame in good_frames.items():
         # Crop the region containing critter icons.
@@ -225,35 +237,44 @@ def _remove_blanks(all_icons: List[CritterIcon]) -> List[CritterIcon]:
 def _get_critter_db() -> Dict[CritterType, List[CritterImage]]:
     """Fetches the critters database for a given locale, with caching."""
     critter_data = read_json_asset(CRITTERS_PATH / "names.json")
+    images = read_image_pack(CRITTERS_PATH, _get_image_filenames())
 
     critter_db = collections.defaultdict(list)
-    for critter_name, icon_name, critter_type_str in critter_data:
+    for (critter_name, icon_name, critter_type_str), img in zip(critter_data, images):
         critter_type = CritterType.from_str(critter_type_str)
-        critter = CritterImage(critter_name, critter_type, icon_name)
+        critter = CritterImage(critter_name, critter_type, icon_name, img)
         critter_db[critter_type].append(critter)
     return critter_db
 
 
-def _find_best_match(icon: FRAME_TYPE, critters: List[CritterImage]) -> CritterImage:
-    """Finds the closest matching critter for the given icon."""
-    fast_similarity_metric = lambda r: cv2.absdiff(icon, r.img).mean()  # noqa: E731
-    similarities = list(map(fast_similarity_metric, critters))
-    sim1, sim2 = np.partition(similarities, kth=2)[:2]
-
-    # If the match seems obvious, return the quick result.
-    if abs(sim1 - sim2) > 3:
-        return critters[np.argmin(similarities)]
+def _get_image_filenames() -> List[str]:
+    """Lists the critter icons."""
+    return [icon_name for _, icon_name, _ in read_json_asset(CRITTERS_PATH / "names.json")]
 
-    # Otherwise, we use a slower matching, which tries various shifts.
-    def slow_similarity_metric(critter: CritterImage) -> float:
-        diffs = []
-        for x in [-2, -1, 0, 1, 2]:
-            shifted = np.roll(icon, x, axis=1)
-            diffs.append(cv2.absdiff(shifted, critter.img).sum())
-        return min(diffs)  # type: ignore[no-any-return]  # Return lowest diff across shifts.
 
-    similarities = list(map(slow_similarity_metric, critters))
-    return critters[np.argmin(similarities)]
+@functools.lru_cache()
+def _get_critter_matcher(critter_type: CritterType) -> ImageMatcher:
+    """Stacks the critter images of a given type for matching, with caching."""
+    images = [critter.img for critter in _get_critter_db()[critter_type]]
+    return ImageMatcher(np.stack(images), MATCH_SHIFTS)
+
+
+def _find_best_matches(icons: FRAME_TYPE, matcher: ImageMatcher) -> np.ndarray:
+    """Finds the index of the closest matching critter for each of the given icons."""
+    distances = matcher.distances(icons)
+    similarities = distances / np.prod(matcher.shape)  # Mean pixel distance.
+    sim1, sim2 = np.partition(similarities, kth=2, axis=1)[:, :2].T
+    best_matches = np.argmin(distances, axis=1)
+
+    # If the match seems obvious, keep the quick result.
+    ambiguous = np.abs(sim1 - sim2) <= MATCH_MARGIN
+    if not ambiguous.all():
+        count("matches_fast", int(np.count_nonzero(~ambiguous)))
+    if ambiguous.any():
+        # Otherwise, we use a slower matching, which tries various shifts.
+        count("matches_slow", int(np.count_nonzero(ambiguous)))
+        best_matches[ambiguous] = np.argmin(matcher.shifted_distances(icons[ambiguous]), axis=1)
+    return best_matches  # type: ignore[no-any-return]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,421 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+import collections
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+from types import TracebackType
+from typing import IO, Any, Callable, Iterator, Optional, Type, Union
+
+import cv2
+import numpy as np
+
+from catalogscanner.common import FRAME_TYPE, current_stats
+
+# How many decoded frames may wait for the scanner (~2.7 MB each at 720p).
+QUEUE_SIZE = 8
+
+# How many frames read with `peek` are kept to replay them. Peeking further decodes the media again instead.
+PEEK_BUFFER_SIZE = QUEUE_SIZE
+
+
+class _EndOfMedia:
+    """Marker put in the queue once the decoder thread is done."""
+
+
+_DecodedItem = Union[tuple[int, FRAME_TYPE], BaseException, _EndOfMedia]
+
+# Region of interest of the frames as `(y1, y2, x1, x2)`, like the numpy slices in the scanners.
+REGION_TYPE = tuple[int, int, int, int]
+
+
+class FrameBackend:
+    """Decodes the frames of a media file for a `FrameSource`.
+
+    Decoding is split in two steps like `cv2.VideoCapture`: `grab` advances to
+    the next frame and `retrieve` converts it to an image, which is skipped for
+    frames the scanner does not want. With a `region`, only that region of the
+    frames is returned.
+    """
+
+    def __init__(self, filename: Path, region: Optional[REGION_TYPE] = None) -> None:
+        self.filename = filename
+        self.region = region
+
+    def grab(self) -> bool:
+        """Advances to the next frame, returns False once the media is over."""
+        raise NotImplementedError
+
+    def retrieve(self) -> Optional[FRAME_TYPE]:
+        """Returns the last grabbed frame as an image."""
+        raise NotImplementedError
+
+    def seek(self, index: int) -> None:
+        """Moves to the frame with the given index, so it is the next one grabbed."""
+        for _ in range(index):
+            if not self.grab():
+                break
+
+    def release(self) -> None:
+        """Frees all resources held by the decoder."""
+
+    def _crop(self, frame: FRAME_TYPE) -> FRAME_TYPE:
+        """Returns a view of the region of a whole frame."""
+        if self.region is None:
+            return frame
+        y1, y2, x1, x2 = self.region
+        return frame[y1:y2, x1:x2]
+
+
+class OpenCVBackend(FrameBackend):
+    """Decodes through `cv2.VideoCapture`, returns BGR frames."""
+
+    def __init__(self, filename: Path, region: Optional[REGION_TYPE] = None) -> None:
+        super().__init__(filename, region)
+        self._capture = cv2.VideoCapture(filename)  # type: ignore[call-overload]
+
+    def grab(self) -> bool:
+        return self._capture.grab()  # type: ignore[no-any-return]
+
+    def retrieve(self) -> Optional[FRAME_TYPE]:
+        ret, frame = self._capture.retrieve()
+        return self._crop(frame) if ret else None
+
+    def seek(self, index: int) -> None:
+        self._capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+
+    def release(self) -> None:
+        self._capture.release()
+
+
+class PyAVBackend(FrameBackend):
+    """Decodes with PyAV using FFmpeg's frame and slice threading, returns BGR frames."""
+
+    def __init__(self, filename: Path, region: Optional[REGION_TYPE] = None) -> None:
+        super().__init__(filename, region)
+        try:
+            import av
+        except ImportError:
+            raise RuntimeError("The pyav backend requires PyAV, install it with: pip install av") from None
+
+        # Image sequences need the image2 demuxer to expand the `%d` pattern.
+        self._container = av.open(str(filename), format="image2" if "%d" in filename.name else None)
+        stream = self._container.streams.video[0]
+        stream.thread_type = "AUTO"
+        self._frames: Iterator[Any] = self._container.decode(stream)
+        self._frame: Any = None
+
+    def grab(self) -> bool:
+        self._frame = next(self._frames, None)
+        return self._frame is not None
+
+    def retrieve(self) -> Optional[FRAME_TYPE]:
+        if self._frame is None:
+            return None
+        return self._crop(self._frame.to_ndarray(format="bgr24"))
+
+    def release(self) -> None:
+        self._container.close()
+
+
+class FFmpegBackend(FrameBackend):
+    """Decodes in an `ffmpeg` subprocess and streams raw BGR frames through a pipe.
+
+    With a `region`, ffmpeg crops the frames before converting them to BGR, so
+    the rest of each frame is never converted or moved through the pipe. The
+    region has to start at even coordinates, chroma is subsampled by two.
+    """
+
+    def __init__(self, filename: Path, region: Optional[REGION_TYPE] = None) -> None:
+        super().__init__(filename, region)
+        executable = shutil.which("ffmpeg")
+        if not executable:
+            raise RuntimeError("The ffmpeg backend requires the ffmpeg executable in PATH")
+
+        command = [executable, "-v", "error", "-nostdin", "-i", str(filename), "-vsync", "passthrough"]
+        height, width = probe_resolution(filename)
+        if region is not None:
+            y1, y2, x1, x2 = region
+            assert 0 <= y1 < y2 <= height and 0 <= x1 < x2 <= width, "Region is outside of the frames."
+            assert y1 % 2 == x1 % 2 == 0, "Region must start at even coordinates to crop subsampled colors exactly."
+            height, width = y2 - y1, x2 - x1
+            command += ["-vf", f"crop={width}:{height}:{x1}:{y1}:exact=1"]
+        command += ["-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"]
+        self.shape = (height, width, 3)
+        self._frame_size = height * width * 3
+        self._data = b""
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=self._frame_size)
+        self._stdout: IO[bytes] = self._process.stdout  # type: ignore[assignment]
+
+    def grab(self) -> bool:
+        self._data = self._stdout.read(self._frame_size)
+        return len(self._data) == self._frame_size
+
+    def retrieve(self) -> Optional[FRAME_TYPE]:
+        if len(self._data) != self._frame_size:
+            return None
+        return np.frombuffer(self._data, dtype=np.uint8).reshape(self.shape)
+
+    def release(self) -> None:
+        self._process.kill()
+        self._process.wait()
+        self._stdout.close()
+
+
+BACKENDS: dict[str, Callable[[Path, Optional[REGION_TYPE]], FrameBackend]] = {
+    "opencv": OpenCVBackend,
+    "pyav": PyAVBackend,
+    "ffmpeg": FFmpegBackend,
+}
+
+
+class FrameSampler:
+    """Tells a frame source which frames the scanner is going to look at.
+
+    Sampling starts once the scanner calls `start` for the first frame it
+    accepts, from then on only every `stride`-th frame of the video is handed
+    out. The stride counts from the first frame of the whole video, so segments
+    of a video decoded separately sample the same frames. Frames passed over
+    with `skip` are dropped as well. Frames that are not wanted are only
+    grabbed by the decoder, never retrieved and colour-converted.
+    """
+
+    def __init__(self, stride: int = 1) -> None:
+        self.stride = stride
+        self.position = -1  # Index of the last frame handed to the scanner.
+        self._started = False
+        self._skip_until = -1
+
+    def start(self) -> None:
+        """Starts handing out only every `stride`-th frame, if not done already."""
+        self._started = True
+
+    def skip(self, count: int) -> None:
+        """Drops the next `count` frames after the current one."""
+        self._skip_until = self.position + count
+
+    def wants(self, index: int) -> bool:
+        """Checks whether the frame with the given index should be decoded."""
+        if index <= self._skip_until:
+            return False
+        if not self._started:
+            return True
+        return index % self.stride == 0
+
+
+class FrameSource:
+    """Decodes the frames of a video, screenshot or image sequence exactly once.
+
+    Decoding runs ahead on a background thread into a bounded queue, which lets
+    OpenCV decode (it releases the GIL) while the scanner is busy with the
+    previous frames. Up to `PEEK_BUFFER_SIZE` frames read with `peek` are kept
+    in a buffer and replayed when iterating over the source, so media type
+    detection does not decode them twice. After peeking further, decoding starts
+    over from the first frame instead. Scanners that only need some of the frames iterate with a
+    `FrameSampler` to keep the decoder from retrieving the rest.
+
+    The decoder is picked by name from `BACKENDS`, or given as a callable
+    returning a `FrameBackend` for the filename and region. With `start` and
+    `end` only that range of frames is decoded, frame indices stay relative to
+    the whole video. With a `region` only that region of the frames is handed
+    out, which the ffmpeg backend crops before the frames ever leave the decoder.
+    """
+
+    def __init__(
+        self,
+        filename: Path,
+        backend: str | Callable[[Path, Optional[REGION_TYPE]], FrameBackend] = "opencv",
+        queue_size: int = QUEUE_SIZE,
+        start: int = 0,
+        end: Optional[int] = None,
+        region: Optional[REGION_TYPE] = None,
+    ) -> None:
+        if isinstance(backend, str) and backend not in BACKENDS:
+            raise RuntimeError("Invalid frame backend: %r" % backend)
+
+        self.filename = filename
+        self.backend = backend
+        self.start = start
+        self.end = end
+        self.region = region
+        self._backend = BACKENDS[backend] if isinstance(backend, str) else backend
+        self._queue: queue.Queue[_DecodedItem] = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._buffer: collections.deque[tuple[int, FRAME_TYPE]] = collections.deque()
+        self._rewind = False  # Whether frames were peeked past the buffer.
+        self._sampler = FrameSampler()
+        self._finished = False
+        self._stats = current_stats()  # Context variables are not passed on to the decoder thread.
+
+    def __enter__(self) -> "FrameSource":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def __iter__(self) -> Iterator[FRAME_TYPE]:
+        """Yields all remaining frames, starting with the buffered ones."""
+        return self.sample(FrameSampler())
+
+    def sample(self, sampler: FrameSampler) -> Iterator[FRAME_TYPE]:
+        """Yields the remaining frames the sampler wants, starting with the buffered ones."""
+        if self._rewind:
+            self._restart()
+        self._sampler = sampler
+        while self._buffer:
+            index, frame = self._buffer.popleft()
+            if sampler.wants(index):
+                sampler.position = index
+                yield frame
+        while (item := self._read()) is not None:
+            # The decoder may be ahead of the sampler, so check again.
+            index, frame = item
+            if sampler.wants(index):
+                sampler.position = index
+                yield frame
+        self.close()
+
+    def peek(self, count: int) -> Iterator[FRAME_TYPE]:
+        """Yields up to `count` frames from the start without consuming them."""
+        if self._rewind:
+            self._restart()
+        for _, frame in list(self._buffer)[:count]:
+            yield frame
+        peeked = len(self._buffer)
+        while peeked < count and (item := self._read()) is not None:
+            peeked += 1
+            if len(self._buffer) == PEEK_BUFFER_SIZE:
+                # Too many frames to keep, they get decoded again.
+                self._buffer.clear()
+                self._rewind = True
+            if not self._rewind:
+                self._buffer.append(item)
+            yield item[1]
+
+    def close(self) -> None:
+        """Stops the decoder thread, buffered frames stay available."""
+        self._finished = True
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # Drop frames decoded ahead so they don't outlive the scan.
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def _restart(self) -> None:
+        """Stops the decoder and drops the frames it decoded, so decoding starts over from the first frame."""
+        self.close()
+        self._buffer.clear()
+        self._stopped.clear()
+        self._finished = False
+        self._rewind = False
+
+    def _read(self) -> Optional[tuple[int, FRAME_TYPE]]:
+        if self._finished:
+            return None
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._decode, name="FrameSource", daemon=True)
+            self._thread.start()
+
+        item = self._queue.get()
+        if isinstance(item, _EndOfMedia):
+            self.close()  # Video is over
+            return None
+        if isinstance(item, BaseException):
+            self.close()
+            raise item
+        return item
+
+    def _decode(self) -> None:
+        """Decoder thread, reads frames until the media is over or the source is closed."""
+        decoder: Optional[FrameBackend] = None
+        started, cpu, wall = time.perf_counter(), time.thread_time(), 0.0
+        try:
+            decoder = self._backend(self.filename, self.region)
+            if self.start:
+                decoder.seek(self.start)
+            wall = time.perf_counter() - started
+            index = self.start
+            while not self._stopped.is_set() and (self.end is None or index < self.end):
+                started = time.perf_counter()
+                if not decoder.grab():
+                    break
+                wanted = self._sampler.wants(index)
+                frame = decoder.retrieve() if wanted else None
+                if wanted and frame is None:
+                    break
+                wall += time.perf_counter() - started  # Not counting the time waiting for the scanner.
+
+                if frame is None:
+                    self._stats.count("frames_skipped")
+                else:
+                    self._stats.count("frames_decoded")
+                    self._put((index, frame))
+                index += 1
+        except Exception as e:
+            self._put(e)
+        finally:
+            if decoder is not None:
+                decoder.release()
+            self._stats.add_time("decode", wall, time.thread_time() - cpu)
+            self._put(_EndOfMedia())
+
+    def _put(self, item: _DecodedItem) -> None:
+        """Blocks until the scanner made room in the queue, unless the source gets closed."""
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+def probe_resolution(filename: Path) -> tuple[int, int]:
+    """Reads the frame size of the media from its headers."""
+    capture = cv2.VideoCapture(filename)  # type: ignore[call-overload]
+    try:
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    finally:
+        capture.release()
+    assert height and width, "Failed to read the resolution of the media."
+    return height, width
+
+
+def count_frames(filename: Path) -> int:
+    """Reads the number of frames of the media from its headers, zero if unknown."""
+    capture = cv2.VideoCapture(filename)  # type: ignore[call-overload]
+    try:
+        return max(0, int(capture.get(cv2.CAP_PROP_FRAME_COUNT)))
+    finally:
+        capture.release()
+
+
+def open_frames(media: Path | FrameSource, region: Optional[REGION_TYPE] = None) -> FrameSource:
+    """Returns a frame source for the given media, reusing already opened sources.
+
+    New sources only hand out the `region` of the frames, opened ones hand out
+    the region they were opened with, see `crop_frame`.
+    """
+    if isinstance(media, FrameSource):
+        return media
+    return FrameSource(media, region=region)
+
+
+def crop_frame(frames: FrameSource, frame: FRAME_TYPE, region: REGION_TYPE) -> FRAME_TYPE:
+    """Returns the region of a frame from the source, which is the frame itself if the source is cropped to it."""
+    if frames.region == region:
+        return frame
+    assert frames.region is None, "Frames are cropped to another region."
+    y1, y2, x1, x2 = region
+    return frame[y1:y2, x1:x2]
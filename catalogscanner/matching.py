@@ -0,0 +1,323 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+import collections
+import difflib
+import json
+import mmap
+import unicodedata
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+# File signature and format version of a saved `ItemIndex`.
+INDEX_MAGIC = b"CSITEMS1"
+
+# Arrays of a saved `ItemIndex`, in file order.
+_INDEX_ARRAYS = {
+    "name_bytes": np.uint8,  # UTF-8 of all names, sorted bytewise.
+    "name_offsets": np.int64,  # Start of each name in `name_bytes`, plus the end of the last.
+    "name_lengths": np.int64,  # Number of characters of each name.
+    "masks": np.uint32,  # Bit i is set if the name is an item of locale i.
+    "locale_offsets": np.int64,  # Start of the names of each locale in `locale_names`, plus the end of the last.
+    "locale_names": np.int32,  # Names of each locale, sorted.
+    "posting_keys": np.uint64,  # Locale bit and code point of the chars found in the names of each locale, sorted.
+    "posting_offsets": np.int64,  # Start of the postings of each key, plus the end of the last.
+    "posting_names": np.int32,  # Names containing the char, by their position in `locale_names` of the locale.
+    "posting_counts": np.int32,  # How often the name contains the char.
+}
+
+
+class ItemIndex:
+    """Item names of all locales, with the locales each belongs to and an index for fuzzy matching.
+
+    The index is a handful of flat arrays, which `save` writes to a single file that
+    `load` maps into memory, so processes share its pages instead of each parsing the
+    item databases.
+
+    `best_match` finds the closest name of a locale like `difflib.get_close_matches(word,
+    names, n=1)`. Instead of comparing the word to every name, an inverted index of the
+    characters in each name gives the `quick_ratio` of all names at once. That is an upper
+    bound of the exact ratio, so names are scored best bound first until no remaining
+    name can beat the best match.
+    """
+
+    def __init__(self, locales: List[str], arrays: Dict[str, np.ndarray], buffer: Optional[mmap.mmap] = None) -> None:
+        assert len(locales) <= 32, "Too many locales for the locale masks"
+        self.locales = locales
+        self._buffer = buffer  # Keeps the mapped file open.
+        self._name_bytes = arrays["name_bytes"]
+        self._name_offsets = arrays["name_offsets"]
+        self._name_lengths = arrays["name_lengths"]
+        self._masks = arrays["masks"]
+        self._locale_offsets = arrays["locale_offsets"]
+        self._locale_names = arrays["locale_names"]
+        self._posting_keys = arrays["posting_keys"]
+        self._posting_offsets = arrays["posting_offsets"]
+        self._posting_names = arrays["posting_names"]
+        self._posting_counts = arrays["posting_counts"]
+
+    @classmethod
+    def build(cls, names_by_locale: Dict[str, Iterable[str]]) -> "ItemIndex":
+        """Builds the index of the item names of each locale, normalized to NFKC."""
+        locales = list(names_by_locale)
+        masks: Dict[bytes, int] = collections.defaultdict(int)
+        for bit, locale_items in enumerate(names_by_locale.values()):
+            for item in locale_items:
+                masks[unicodedata.normalize("NFKC", item).encode("utf-8")] |= 1 << bit
+        encoded = sorted(masks)
+        names = [name.decode("utf-8") for name in encoded]
+
+        locale_names: List[List[int]] = [[] for _ in locales]
+        postings: Dict[int, Tuple[List[int], List[int]]] = collections.defaultdict(lambda: ([], []))
+        for i, (key, name) in enumerate(zip(encoded, names)):
+            char_counts = collections.Counter(name).items()
+            for bit in range(len(locales)):
+                if masks[key] >> bit & 1:
+                    for char, char_count in char_counts:
+                        postings[_posting_key(bit, char)][0].append(len(locale_names[bit]))
+                        postings[_posting_key(bit, char)][1].append(char_count)
+                    locale_names[bit].append(i)
+        keys = sorted(postings)
+
+        arrays = {
+            "name_bytes": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            "name_offsets": np.cumsum([0] + [len(name) for name in encoded]),
+            "name_lengths": np.array([len(name) for name in names]),
+            "masks": np.array([masks[name] for name in encoded]),
+            "locale_offsets": np.cumsum([0] + [len(ids) for ids in locale_names]),
+            "locale_names": np.array([i for ids in locale_names for i in ids]),
+            "posting_keys": np.array(keys),
+            "posting_offsets": np.cumsum([0] + [len(postings[key][0]) for key in keys]),
+            "posting_names": np.array([i for key in keys for i in postings[key][0]]),
+            "posting_counts": np.array([n for key in keys for n in postings[key][1]]),
+        }
+        return cls(locales, {key: np.asarray(arrays[key], dtype=dtype) for key, dtype in _INDEX_ARRAYS.items()})
+
+    @classmethod
+    def load(cls, path: Path) -> "ItemIndex":
+        """Maps an index saved by `save` into memory."""
+        with path.open("rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[: len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise RuntimeError("Invalid item index: %r" % str(path))
+
+        header_size = int.from_bytes(buffer[len(INDEX_MAGIC) : len(INDEX_MAGIC) + 8], "little")
+        header = json.loads(buffer[len(INDEX_MAGIC) + 8 : len(INDEX_MAGIC) + 8 + header_size])
+        arrays = {
+            key: np.frombuffer(buffer, dtype=dtype, count=header["counts"][key], offset=header["offsets"][key])
+            for key, dtype in _INDEX_ARRAYS.items()
+        }
+        return cls(header["locales"], arrays, buffer)
+
+    def save(self, path: Path) -> None:
+        """Writes the index to a file, with each array aligned to 8 bytes."""
+        arrays = {key: getattr(self, f"_{key}") for key in _INDEX_ARRAYS}
+        header = {"locales": self.locales, "counts": {key: len(array) for key, array in arrays.items()}}
+
+        # The header holds the offsets of the arrays, which depend on the size of the header.
+        offsets: Dict[str, int] = {}
+        header_size = 0
+        while True:
+            offset = _align(len(INDEX_MAGIC) + 8 + header_size)
+            for key, array in arrays.items():
+                offsets[key] = offset
+                offset = _align(offset + array.nbytes)
+            data = json.dumps(header | {"offsets": offsets}).encode("utf-8")
+            if len(data) <= header_size:
+                break
+            header_size = len(data)
+
+        with path.open("wb") as file:
+            file.write(INDEX_MAGIC + header_size.to_bytes(8, "little") + data.ljust(header_size))
+            for key, array in arrays.items():
+                file.seek(offsets[key])
+                file.write(array.tobytes())
+
+    def __len__(self) -> int:
+        return len(self._masks)
+
+    def locale_mask(self, name: str) -> int:
+        """Returns the bitmask of the locales the name is an item of, 0 if it is none."""
+        i = self._find(name)
+        return int(self._masks[i]) if i is not None else 0
+
+    def contains(self, name: str, locale: str) -> bool:
+        """Checks whether the name is an item of the locale."""
+        return bool(self.locale_mask(name) >> self.locales.index(locale) & 1)
+
+    def names(self, locale: str) -> List[str]:
+        """Returns the item names of the locale, sorted by their UTF-8 encoding."""
+        return [self._name(i) for i in self._get_locale_names(locale)]
+
+    def best_match(self, word: str, locale: str, cutoff: float = 0.6) -> Optional[Tuple[str, float]]:
+        """Returns the closest item name of the locale and its ratio, or None if none scores at least `cutoff`.
+
+        Ties are broken like difflib does, by taking the greatest name.
+        """
+        # Number of characters each name of the locale shares with the word, counting repeated ones.
+        bit = self.locales.index(locale)
+        locale_names = self._get_locale_names(locale)
+        common = np.zeros(len(locale_names), dtype=np.int64)
+        for char, char_count in collections.Counter(word).items():
+            i = int(np.searchsorted(self._posting_keys, _posting_key(bit, char)))
+            if i < len(self._posting_keys) and self._posting_keys[i] == _posting_key(bit, char):
+                start, end = self._posting_offsets[i : i + 2]
+                common[self._posting_names[start:end]] += np.minimum(self._posting_counts[start:end], char_count)
+
+        # Same arithmetic as `SequenceMatcher.quick_ratio`, so bounds and ratios compare exactly. Names
+        # sharing no character with the word have a bound of 0, unless both are empty.
+        if word and cutoff > 0:
+            candidates = np.flatnonzero(common)
+        else:
+            candidates = np.arange(len(locale_names))
+        lengths = self._name_lengths[locale_names[candidates]] + len(word)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bounds = np.where(lengths, 2.0 * common[candidates] / lengths, 1.0)
+        keep = bounds >= cutoff
+        order = np.argsort(-bounds[keep], kind="stable")
+        candidates, bounds = locale_names[candidates[keep][order]], bounds[keep][order]
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)  # difflib caches details about the second sequence.
+        best: Optional[Tuple[float, str]] = None
+        for candidate, bound in zip(candidates.tolist(), bounds.tolist()):
+            if best is not None and bound < best[0]:
+                break
+            name = self._name(candidate)
+            matcher.set_seq1(name)
+            ratio = matcher.ratio()
+            if ratio >= cutoff and (best is None or (ratio, name) > best):
+                best = (ratio, name)
+
+        return (best[1], best[0]) if best is not None else None
+
+    def _get_locale_names(self, locale: str) -> np.ndarray:
+        bit = self.locales.index(locale)
+        return self._locale_names[self._locale_offsets[bit] : self._locale_offsets[bit + 1]]
+
+    def _name(self, i: int) -> str:
+        return bytes(self._name_bytes[self._name_offsets[i] : self._name_offsets[i + 1]]).decode("utf-8")
+
+    def _find(self, name: str) -> Optional[int]:
+        """Binary searches the index of a name."""
+        encoded = name.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self._name_bytes[self._name_offsets[middle] : self._name_offsets[middle + 1]]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self._name(low) == name:
+            return low
+        return None
+
+
+class ImageMatcher:
+    """Reference images of the same shape, compared to many images at once.
+
+    The distance of two images is the sum of the absolute differences of their pixels,
+    which `cv2.batchDistance` computes for every pair of images and references in one
+    call. The references are also stored shifted horizontally by each of `shifts`, to
+    compare images that may be off by a few pixels.
+    """
+
+    def __init__(self, references: np.ndarray, shifts: Sequence[int] = (0,)) -> None:
+        self.shape = references.shape[1:]
+        self.shifts = list(shifts)
+        self._references = references.reshape(len(references), -1)
+        # Shifting a reference left is the same as shifting the image right, as both wrap around.
+        shifted = [np.roll(references, -shift, axis=2) for shift in self.shifts]
+        self._shifted = np.concatenate(shifted).reshape(len(self.shifts) * len(references), -1)
+
+    def __len__(self) -> int:
+        return len(self._references)
+
+    def distances(self, images: np.ndarray) -> np.ndarray:
+        """Returns the (images, references) matrix of distances."""
+        return self._batch_distances(images, self._references)
+
+    def shifted_distances(self, images: np.ndarray) -> np.ndarray:
+        """Returns the (images, references) matrix of the lowest distances across all shifts."""
+        distances = self._batch_distances(images, self._shifted)
+        return distances.reshape(len(images), len(self.shifts), len(self)).min(axis=1)  # type: ignore[no-any-return]
+
+    def _batch_distances(self, images: np.ndarray, references: np.ndarray) -> np.ndarray:
+        assert images.shape[1:] == self.shape, f"Expected images of shape {self.shape}"
+        distances = np.zeros((len(images), len(references)), dtype=np.int64)
+        if not len(images):
+            return distances
+
+        # Without `K` batchDistance can't be called from Python, so ask for all references
+        # as nearest neighbours and put the distances back in reference order.
+        nearest, indexes = cv2.batchDistance(
+            images.reshape(len(images), -1), references, cv2.CV_32S, normType=cv2.NORM_L1, K=len(references)
+        )
+        np.put_along_axis(distances, indexes, nearest, axis=1)  # type: ignore[arg-type]
+        return distances
+
+
+class HammingIndex:
+    """Binary hashes packed into rows of uint64 words, searched by Hamming distance.
+
+    The distances of many hashes to all hashes of the index are computed at once, by
+    XOR-ing the words and counting the set bits. Hashes can be added at any time.
+    """
+
+    def __init__(self, hashes: np.ndarray) -> None:
+        self._hashes = np.array(hashes, dtype=np.uint64, ndmin=2)
+        self._size = len(hashes)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, hashes: np.ndarray) -> None:
+        """Appends packed hashes to the index."""
+        if self._size + len(hashes) > len(self._hashes):
+            capacity = max(2 * len(self._hashes), self._size + len(hashes))
+            grown = np.empty((capacity, self._hashes.shape[1]), dtype=np.uint64)
+            grown[: self._size] = self._hashes[: self._size]
+            self._hashes = grown
+        self._hashes[self._size : self._size + len(hashes)] = hashes
+        self._size += len(hashes)
+
+    def distances(self, hashes: np.ndarray) -> np.ndarray:
+        """Returns the (hashes, index) matrix of Hamming distances of packed hashes.
+
+        The words are compared one at a time, so no temporary array is larger than the matrix.
+        """
+        distances = np.zeros((len(hashes), self._size), dtype=np.int64)
+        for word in range(self._hashes.shape[1]):
+            distances += np.bitwise_count(hashes[:, word, None] ^ self._hashes[: self._size, word])
+        return distances
+
+    def search(self, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the closest hash of the index to each packed hash, its distance and margin.
+
+        The margin is how much further the second closest hash is, the number of bits if there is none.
+        """
+        distances = self.distances(hashes)
+        best = np.argmin(distances, axis=1)
+        distance = distances[np.arange(len(hashes)), best]
+        if self._size < 2:
+            return best, distance, np.full(len(hashes), self._hashes.shape[1] * 64)
+        second = np.partition(distances, 1, axis=1)[:, 1]
+        return best, distance, second - distance
+
+
+def pack_hashes(bits: np.ndarray) -> np.ndarray:
+    """Packs (hashes, bits) arrays of booleans into rows of uint64 words for a `HammingIndex`."""
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    padded = np.zeros((len(bits), -(-packed.shape[1] // 8) * 8), dtype=np.uint8)
+    padded[:, : packed.shape[1]] = packed
+    return padded.view(np.uint64)
+
+
+def _posting_key(bit: int, char: str) -> int:
+    return bit << 21 | ord(char)  # Code points take up to 21 bits.
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
@@ -4,15 +4,17 @@
 # Copyright (c) 2024 Nachtalb
 # This file contains both MIT and LGPL-3.0-or-later licensed code.
 import functools
+import logging
 from pathlib import Path
-from typing import Iterator, List
+from typing import Iterator, List, Tuple
 
 import cv2
-import imagehash
 import numpy as np
-from PIL import Image
 
-from catalogscanner.common import ASSET_PATH, FRAME_TYPE, ScanMode, ScanResult, read_json_asset
+from catalogscanner.common import ASSET_PATH, FRAME_TYPE, ScanMode, ScanResult, count, read_json_asset, stage
+from catalogscanner.frames import FrameSampler, FrameSource, open_frames
+from catalogscanner.matching import HammingIndex, pack_hashes
+from catalogscanner.segments import map_segments
 
 # The expected color for the video background.
 BG_COLOR1 = (240, 210, 100)
@@ -22,6 +24,9 @@ BG_COLOR4 = (83, 117, 173)
 
 MUSIC_PATH = ASSET_PATH / "music"
 
+# Side of the square phash of the song covers, in bits.
+HASH_SIZE = 18
+
 
 class SongCover:
     """The image and data associated with a given song."""
@@ -30,6 +35,8 @@ class SongCover:
         self.song_name = song_name
         self.image_name = image_name
         self.hash_hex = hash_hex
+        import imagehash  # Deferred, only needed once the song database is loaded.
+
         self.icon_hash = imagehash.hex_to_hash(hash_hex)
 
     def __repr__(self) -> str:
@@ -44,10 +51,13 @@ def detect(frame: FRAME_TYPE) -> bool:
     return False
 
 
-def scan(video_file: Path, locale: str = "en-us") -> ScanResult:
+def scan(video_file: Path | FrameSource, locale: str = "en-us", jobs: int = 1) -> ScanResult:
     """Scans a video of scrolling through music list and returns all songs found."""
-    song_covers = parse_video(video_file)
-    song_names = match_songs(song_covers)
+    with stage("parse"):
+        song_covers = parse_video(video_file, jobs)
+    count("covers", len(song_covers))
+    with stage("match"):
+        song_names = match_songs(song_covers)
     results = translate_names(song_names, locale)
 
     return ScanResult(
@@ -57,27 +67,42 @@ def scan(video_file: Path, locale: str = "en-us") -> ScanResult:
     )
 
 
-def parse_video(filename: Path) -> List[FRAME_TYPE]:
-    """Parses a whole video and returns images for all song covers found."""
+def parse_video(filename: Path | FrameSource, jobs: int = 1) -> List[FRAME_TYPE]:
+    """Parses a whole video and returns images for all song covers found.
+
+    With more than one job, segments of the video are parsed in parallel processes.
+    """
+    return _remove_blanks([cover for covers in map_segments(_parse_segment, filename, jobs) for cover in covers])
+
+
+def _parse_segment(filename: Path | FrameSource, first: int) -> List[FRAME_TYPE]:
+    """Parses the frames of a video (segment) and returns images for all song covers found from frame `first` on."""
     all_covers: List[FRAME_TYPE] = []
-    for frame in _read_frames(filename):
+    skipped = 0  # Covers found before the first frame only tell which covers were seen last.
+    for index, frame in _read_frames(filename):
         for new_covers in _parse_frame(frame):
             if _is_duplicate_cards(all_covers, new_covers):
                 continue  # Skip non-moving frames
             all_covers.extend(new_covers)
-    return _remove_blanks(all_covers)
+        if index < first:
+            skipped = len(all_covers)
+    return all_covers[skipped:]
 
 
 def match_songs(song_covers: List[FRAME_TYPE]) -> List[str]:
     """Matches icons against database of music covers, finding best matches."""
-    matched_songs = set()
+    import imagehash  # Deferred, pulls in PIL which only matching needs.
+    from PIL import Image
+
+    if not song_covers:
+        return []
+
     song_db = _get_song_db()
-    for cover in song_covers:
-        image = Image.fromarray(cover)
-        test_hash = imagehash.phash(image, hash_size=18)
-        best_match = min(song_db, key=lambda x: x.icon_hash - test_hash)
-        matched_songs.add(best_match.song_name)
-    return sorted(matched_songs)
+    test_hashes = [imagehash.phash(Image.fromarray(cover), hash_size=HASH_SIZE).hash for cover in song_covers]
+    best_matches, distances, margins = _get_song_index().search(pack_hashes(np.stack(test_hashes)))
+    for best_match, distance, margin in zip(best_matches, distances, margins):
+        logging.debug("Matched cover to %r (distance %d, margin %d)", song_db[best_match].song_name, distance, margin)
+    return sorted({song_db[best_match].song_name for best_match in best_matches})
 
 
 def translate_names(song_names: List[str], locale: str) -> List[str]:
@@ -89,23 +114,18 @@ def translate_names(song_names: List[str], locale: str) -> List[str]:
     return [translations[name][locale] for name in song_names]
 
 
-def _read_frames(filename: Path) -> Iterator[FRAME_TYPE]:
-    """Parses frames of the given video and returns the relevant region."""
-    cap = cv2.VideoCapture(filename)  # type: ignore[call-overload]
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # Video is over
-
-        assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
-
-        if not detect(frame):
-            continue  # Skip frames that are not showing music list.
+def _read_frames(filename: Path | FrameSource) -> Iterator[Tuple[int, FRAME_TYPE]]:
+    """Parses frames of the given video and returns the index and relevant region of each."""
+    sampler = FrameSampler()
+    with open_frames(filename) as frames:
+        for frame in frames.sample(sampler):
+            assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
 
-        # Crop the region containing only song covers.
-        yield frame[95:670, 40:1240]
+            if not detect(frame):
+                continue  # Skip frames that are not showing music list.
 
-    cap.release()
+            # Crop the region containing only song covers.
+            yield sampler.position, frame[95:670, 40:1240]
 
 
 def _parse_frame(frame: FRAME_TYPE) -> Iterator[List[FRAME_TYPE]]:
@@ -195,6 +215,12 @@ def _get_song_db() -> List[SongCover]:
     return [SongCover(*data) for data in music_data]
 
 
+@functools.lru_cache()
+def _get_song_index() -> HammingIndex:
+    """Packs the hashes of the song covers for matching, with caching."""
+    return HammingIndex(pack_hashes(np.stack([song.icon_hash.hash for song in _get_song_db()])))
+
+
 if __name__ == "__main__":
     results = scan(Path("examples/music.mp4"))
     print("\n".join(results.items))
@@ -0,0 +1,344 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import logging
+import math
+import os
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import numpy as np
+
+from catalogscanner.common import FRAME_TYPE, ROWS_TYPE, count
+
+# Page segmentation mode for a uniform block of text, like the list of item names.
+PSM_SINGLE_BLOCK = 6
+
+# Tesseract fails on images taller than 32k pixels.
+MAX_CHUNK_HEIGHT = 31500
+
+# Chunks are not split any smaller than this to spread them over more workers.
+MIN_CHUNK_HEIGHT = 3500
+
+# Compacted rows are split into at least this many chunks of similar width.
+MIN_WIDTH_GROUPS = 4
+
+# Background columns kept right of the text of a compacted row.
+TRIM_MARGIN = 10
+
+_EngineKey = Tuple[str, int, Tuple[Tuple[str, str], ...]]
+
+T = TypeVar("T")
+
+
+class OcrEngine:
+    """Recognizes text in images for one Tesseract language and configuration.
+
+    An engine is only ever used by one thread at a time, the `EnginePool` hands
+    them out.
+    """
+
+    def __init__(self, lang: str, psm: int = PSM_SINGLE_BLOCK, variables: Optional[Dict[str, str]] = None) -> None:
+        self.lang = lang
+        self.psm = psm
+        self.variables = variables or {}
+
+    def image_to_string(self, image: FRAME_TYPE) -> str:
+        """Returns the text found in the image."""
+        raise NotImplementedError
+
+    def image_to_lines(self, image: FRAME_TYPE) -> List[Tuple[int, int, str]]:
+        """Returns the top, bottom and text of each line of text found in the image."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Frees the Tesseract resources of the engine."""
+
+
+class TesserocrEngine(OcrEngine):
+    """Keeps a Tesseract API handle in process, so the language model is only loaded once."""
+
+    def __init__(self, lang: str, psm: int = PSM_SINGLE_BLOCK, variables: Optional[Dict[str, str]] = None) -> None:
+        super().__init__(lang, psm, variables)
+        import tesserocr
+
+        self._api = tesserocr.PyTessBaseAPI(lang=lang, psm=psm, variables=self.variables)
+
+    def image_to_string(self, image: FRAME_TYPE) -> str:
+        self._set_image(image)
+        return self._api.GetUTF8Text()  # type: ignore[no-any-return]
+
+    def image_to_lines(self, image: FRAME_TYPE) -> List[Tuple[int, int, str]]:
+        import tesserocr
+
+        self._set_image(image)
+        self._api.Recognize()
+        iterator = self._api.GetIterator()
+        if iterator is None:
+            return []  # No text found
+
+        lines = []
+        for line in tesserocr.iterate_level(iterator, tesserocr.RIL.TEXTLINE):
+            text, box = line.GetUTF8Text(tesserocr.RIL.TEXTLINE), line.BoundingBox(tesserocr.RIL.TEXTLINE)
+            if text and box:
+                lines.append((box[1], box[3], text.strip()))
+        return lines
+
+    def close(self) -> None:
+        self._api.End()
+
+    def _set_image(self, image: FRAME_TYPE) -> None:
+        # Passes the pixels as they are, like `PIL.Image.fromarray` does for pytesseract.
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        self._api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+
+
+class PytesseractEngine(OcrEngine):
+    """Runs the `tesseract` executable for every image, loading the language model each time."""
+
+    def image_to_string(self, image: FRAME_TYPE) -> str:
+        import pytesseract  # Deferred, pulls in PIL which only OCR needs.
+        from PIL import Image
+
+        text = pytesseract.image_to_string(Image.fromarray(image), lang=self.lang, config=self._config())
+        assert isinstance(text, str), "Tesseract returned bytes"
+        return text
+
+    def image_to_lines(self, image: FRAME_TYPE) -> List[Tuple[int, int, str]]:
+        import pytesseract
+        from PIL import Image
+
+        data = pytesseract.image_to_data(
+            Image.fromarray(image), lang=self.lang, config=self._config(), output_type=pytesseract.Output.DICT
+        )
+        # Tesseract only reports words, so join the words of each line.
+        lines: Dict[Tuple[int, int, int], Tuple[int, int, List[str]]] = {}
+        for i, word in enumerate(data["text"]):
+            if not word.strip():
+                continue
+            key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            top, bottom = data["top"][i], data["top"][i] + data["height"][i]
+            line_top, line_bottom, words = lines.get(key, (top, bottom, []))
+            words.append(word)
+            lines[key] = (min(top, line_top), max(bottom, line_bottom), words)
+        return [(top, bottom, " ".join(words)) for top, bottom, words in lines.values()]
+
+    def _config(self) -> str:
+        return " ".join([f"--psm {self.psm}"] + [f"-c {key}={value}" for key, value in self.variables.items()])
+
+
+ENGINES: Dict[str, Callable[..., OcrEngine]] = {
+    "tesserocr": TesserocrEngine,
+    "pytesseract": PytesseractEngine,
+}
+
+
+class EnginePool:
+    """Keeps idle engines per language and configuration for reuse across scans."""
+
+    def __init__(self, engine: Callable[..., OcrEngine]) -> None:
+        self._engine = engine
+        self._idle: Dict[_EngineKey, List[OcrEngine]] = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def engine(
+        self, lang: str, psm: int = PSM_SINGLE_BLOCK, variables: Optional[Dict[str, str]] = None
+    ) -> Iterator[OcrEngine]:
+        """Borrows an engine for the calling thread, creating a new one if all are busy."""
+        key = (lang, psm, tuple(sorted((variables or {}).items())))
+        with self._lock:
+            engine = self._idle[key].pop() if self._idle[key] else None
+        if engine is None:
+            logging.debug("Starting OCR engine for %s", lang)
+            count("ocr_engines_started")
+            engine = self._engine(lang, psm, variables)
+
+        try:
+            yield engine
+        finally:
+            with self._lock:
+                self._idle[key].append(engine)
+
+    def close(self) -> None:
+        """Frees all idle engines."""
+        with self._lock:
+            engines = [engine for engines in self._idle.values() for engine in engines]
+            self._idle.clear()
+        for engine in engines:
+            engine.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_pool() -> EnginePool:
+    """Returns the shared engine pool, using in-process Tesseract if tesserocr is installed."""
+    try:
+        import tesserocr  # noqa: F401
+    except ImportError:
+        logging.debug("tesserocr is not installed, falling back to pytesseract")
+        return EnginePool(ENGINES["pytesseract"])
+    return EnginePool(ENGINES["tesserocr"])
+
+
+def image_to_string(
+    image: FRAME_TYPE, lang: str, psm: int = PSM_SINGLE_BLOCK, variables: Optional[Dict[str, str]] = None
+) -> str:
+    """Returns the text found in the image by an engine of the shared pool."""
+    with get_pool().engine(lang, psm, variables) as engine:
+        return engine.image_to_string(image)
+
+
+def image_rows_to_strings(
+    rows: ROWS_TYPE,
+    lang: str,
+    psm: int = PSM_SINGLE_BLOCK,
+    variables: Optional[Dict[str, str]] = None,
+    workers: Optional[int] = None,
+    compact: bool = False,
+) -> List[str]:
+    """Stacks the rows into chunks of images and returns the text found in each, in order.
+
+    The chunks are recognized concurrently by `workers` threads, one per CPU by default.
+    With `compact`, the rows are first compacted by `compact_rows`, which reorders them.
+    """
+
+    def recognize(chunk: ROWS_TYPE) -> str:
+        logging.debug("Running Tesseract on %s rows", len(chunk))
+        return image_to_string(_stack(chunk), lang, psm, variables)
+
+    workers = workers or os.cpu_count() or 1
+    if compact:
+        rows = compact_rows(rows)[0]
+    return _map_chunks(recognize, split_chunks(rows, workers, MIN_WIDTH_GROUPS if compact else 1), workers)
+
+
+def image_rows_to_row_strings(
+    rows: ROWS_TYPE,
+    lang: str,
+    psm: int = PSM_SINGLE_BLOCK,
+    variables: Optional[Dict[str, str]] = None,
+    workers: Optional[int] = None,
+    compact: bool = False,
+) -> List[str]:
+    """Like `image_rows_to_strings`, but returns the text of each row, in order.
+
+    Recognized lines are assigned to the row containing their vertical center,
+    rows without any text get an empty string.
+    """
+
+    def recognize(chunk: ROWS_TYPE) -> List[str]:
+        logging.debug("Running Tesseract on %s rows", len(chunk))
+        with get_pool().engine(lang, psm, variables) as engine:
+            lines = engine.image_to_lines(_stack(chunk))
+
+        heights = _row_heights(chunk)
+        offsets = np.cumsum(heights) - heights
+        row_lines: List[List[str]] = [[] for _ in chunk]
+        for top, bottom, text in lines:
+            row_lines[np.searchsorted(offsets, (top + bottom) // 2, side="right") - 1].append(text)
+        return [" ".join(texts) for texts in row_lines]
+
+    workers = workers or os.cpu_count() or 1
+    if not compact:
+        chunks = split_chunks(rows, workers)
+        return [text for texts in _map_chunks(recognize, chunks, workers) for text in texts]
+
+    # Put the text of the compacted rows back in the order of the rows.
+    compacted, order = compact_rows(rows)
+    chunks = split_chunks(compacted, workers, MIN_WIDTH_GROUPS)
+    texts = [""] * len(order)
+    for i, text in zip(order, (text for texts in _map_chunks(recognize, chunks, workers) for text in texts)):
+        texts[i] = text
+    return texts
+
+
+def compact_rows(rows: ROWS_TYPE) -> Tuple[List[FRAME_TYPE], np.ndarray]:
+    """Binarizes rows of the same size and trims the background right of their text.
+
+    Returns the compacted rows sorted by width, widest first, and the index of each in `rows`.
+    Stacking rows of similar width then wastes few pixels on padding.
+    """
+    if not len(rows):
+        return [], np.empty(0, dtype=int)
+    rows = np.asarray(rows)
+    flat = rows.reshape(len(rows), -1)
+
+    # Text is darker than halfway between the darkest pixel and the background, the most common brightness.
+    background = np.median(flat, axis=1)
+    threshold = (flat.min(axis=1) + background) / 2
+    text = rows < threshold[:, None, None]
+
+    text_columns = text.any(axis=1)
+    widths = rows.shape[2] - np.argmax(text_columns[:, ::-1], axis=1) + TRIM_MARGIN
+    widths = np.where(text_columns.any(axis=1), np.minimum(widths, rows.shape[2]), 1)
+
+    binary = np.where(text, 0, 255).astype(np.uint8)
+    order = np.argsort(-widths, kind="stable")
+    return [binary[i, :, : widths[i]] for i in order], order
+
+
+def split_chunks(rows: ROWS_TYPE, workers: int, min_chunks: int = 1) -> List[ROWS_TYPE]:
+    """Splits the rows into consecutive chunks of even height for up to `workers` threads.
+
+    Chunks are at most `MAX_CHUNK_HEIGHT` plus one row high, which is below Tesseract's size limit.
+    At least `min_chunks` chunks are made if the rows are tall enough. Chunks of a stacked
+    array of rows are views of it.
+    """
+    heights = _row_heights(rows)
+    total_height = int(heights.sum())
+    if not total_height:
+        return []
+    chunk_count = max(
+        math.ceil(total_height / MAX_CHUNK_HEIGHT), min(max(workers, min_chunks), total_height // MIN_CHUNK_HEIGHT)
+    )
+
+    # Each row goes to the chunk its top edge falls into.
+    chunk_ids = (np.cumsum(heights) - heights) * chunk_count // total_height
+    bounds = np.searchsorted(chunk_ids, np.arange(chunk_count + 1))
+    return [rows[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _row_heights(rows: ROWS_TYPE) -> np.ndarray:
+    if isinstance(rows, np.ndarray):
+        return np.full(len(rows), rows.shape[1])
+    return np.array([row.shape[0] for row in rows], dtype=np.int64)
+
+
+def _stack(rows: ROWS_TYPE) -> FRAME_TYPE:
+    """Stacks the rows into one image, without copying rows that are already stacked.
+
+    Narrower rows are padded with white on the right.
+    """
+    if isinstance(rows, np.ndarray):
+        return rows.reshape(-1, *rows.shape[2:])
+    width = max(row.shape[1] for row in rows)
+    if all(row.shape[1] == width for row in rows):
+        return np.vstack(rows)
+    return np.vstack([np.pad(row, ((0, 0), (0, width - row.shape[1])), constant_values=255) for row in rows])
+
+
+def _map_chunks(func: Callable[[ROWS_TYPE], T], chunks: List[ROWS_TYPE], workers: int) -> List[T]:
+    """Runs `func` on every chunk concurrently on up to `workers` threads, and returns the results in order."""
+    count("ocr_chunks", len(chunks))
+    count("ocr_pixels", sum(int(_row_heights(chunk).sum()) * max(row.shape[1] for row in chunk) for chunk in chunks))
+    if len(chunks) <= 1 or workers <= 1:
+        return [func(chunk) for chunk in chunks]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(chunks)), thread_name_prefix="OCR") as pool:
+        # Each task runs in a copy of the context, so it records into the stats of the scan.
+        futures = [pool.submit(contextvars.copy_context().run, func, chunk) for chunk in chunks]
+        return [future.result() for future in futures]
+
+
+def warm_up(lang: str, psm: int = PSM_SINGLE_BLOCK, variables: Optional[Dict[str, str]] = None) -> None:
+    """Starts an engine ahead of the first scan, logging languages that fail to load."""
+    try:
+        with get_pool().engine(lang, psm, variables):
+            pass
+    except Exception as e:
+        logging.warning("Failed to start OCR engine for %s: %s", lang, e)
@@ -11,7 +11,17 @@ from typing import Dict, Iterator, List, Optional
 import cv2
 import numpy as np
 
-from catalogscanner.common import ASSET_PATH, FRAME_TYPE, ScanMode, ScanResult, read_json_asset
+from catalogscanner.common import (
+    ASSET_PATH,
+    FRAME_TYPE,
+    ScanMode,
+    ScanResult,
+    count,
+    read_image_pack,
+    read_json_asset,
+    stage,
+)
+from catalogscanner.frames import FrameSource, open_frames
 
 # The expected color for the reactions background.
 BG_COLOR = (254, 221, 244)
@@ -75,9 +85,8 @@ REACTIONS_PATH = ASSET_PATH / "reactions"
 class ReactionImage:
     """The image and data associated with a reaction icon."""
 
-    def __init__(self, reaction_name: str, filename: str) -> None:
-        img_path = REACTIONS_PATH / "generated" / filename
-        self.img = cv2.imread(str(img_path))
+    def __init__(self, reaction_name: str, filename: str, img: FRAME_TYPE) -> None:
+        self.img = img
         self.reaction_name = reaction_name
         self.filename = filename
 
@@ -91,10 +100,13 @@ def detect(frame: FRAME_TYPE) -> bool:
     return np.linalg.norm(color - BG_COLOR) < 5  # type: ignore[return-value]
 
 
-def scan(image_file: Path, locale: str = "en-us") -> ScanResult:
+def scan(image_file: Path | FrameSource, locale: str = "en-us") -> ScanResult:
     """Scans an image of reactions list and returns all reactions found."""
-    reaction_icons = parse_image(image_file)
-    reaction_names = match_reactions(reaction_icons)
+    with stage("parse"):
+        reaction_icons = parse_image(image_file)
+    count("icons", len(reaction_icons))
+    with stage("match"):
+        reaction_names = match_reactions(reaction_icons)
     results = translate_names(reaction_names, locale)
 
     return ScanResult(
@@ -104,30 +116,26 @@ def scan(image_file: Path, locale: str = "en-us") -> ScanResult:
     )
 
 
-def parse_image(filename: Path) -> List[FRAME_TYPE]:
+def parse_image(filename: Path | FrameSource) -> List[FRAME_TYPE]:
     """Parses a screenshot and returns icons for all reactions found."""
     icon_pages: Dict[int, List[FRAME_TYPE]] = {}
     assertion_error: Optional[AssertionError] = None
 
-    cap = cv2.VideoCapture(filename)  # type: ignore[call-overload]
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # Video is over
+    with open_frames(filename) as frames:
+        for frame in frames:
+            if frame.shape[:2] == (1080, 1920):
+                frame = cv2.resize(frame, (1280, 720))
 
-        if frame.shape[:2] == (1080, 1920):
-            frame = cv2.resize(frame, (1280, 720))
+            if not detect(frame):
+                continue  # Skip frames not containing reactions.
 
-        if not detect(frame):
-            continue  # Skip frames not containing reactions.
+            try:
+                new_icons = list(_parse_frame(frame))
+                icon_pages[len(new_icons)] = new_icons
+            except AssertionError as e:
+                assertion_error = e
 
-        try:
-            new_icons = list(_parse_frame(frame))
-            icon_pages[len(new_icons)] = new_icons
-        except AssertionError as e:
-            assertion_error = e
-
-    if assertion_error and (filename.suffix == ".jpg" or not icon_pages):
+    if assertion_error and (frames.filename.suffix == ".jpg" or not icon_pages):
         raise assertion_error
 
     return [icon for page in icon_pages.values() for icon in page]
@@ -180,7 +188,13 @@ def _parse_frame(frame: FRAME_TYPE) -> Iterator[FRAME_TYPE]:
 def _get_reaction_db() -> List[ReactionImage]:
     """Fetches the reaction database for a given locale, with caching."""
     reaction_data = read_json_asset(REACTIONS_PATH / "names.json")
-    return [ReactionImage(name, img) for name, img, _ in reaction_data]
+    images = read_image_pack(REACTIONS_PATH, _get_image_filenames())
+    return [ReactionImage(name, filename, img) for (name, filename, _), img in zip(reaction_data, images)]
+
+
+def _get_image_filenames() -> List[str]:
+    """Lists the reaction icons."""
+    return [filename for _, filename, _ in read_json_asset(REACTIONS_PATH / "names.json")]
 
 
 def _find_best_match(icon: FRAME_TYPE, reactions: List[ReactionImage]) -> ReactionImage:
@@ -191,9 +205,12 @@ def _find_best_match(icon: FRAME_TYPE, reactions: List[ReactionImage]) -> Reacti
 
     # If the match seems obvious, return the quick result.
     if abs(sim1 - sim2) > 3:
+        count("matches_fast")
         return reactions[np.argmin(similarities)]
 
     # Otherwise, we use a slower matching, which tries various shifts.
+    count("matches_slow")
+
     def slow_similarity_metric(reaction: ReactionImage) -> float:
         diffs = []
         for x, y in itertools.product([-1, 0, 1], repeat=2):
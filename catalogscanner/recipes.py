@@ -6,12 +6,23 @@
 import collections
 import functools
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, List, Set, Tuple
 
 import cv2
 import numpy as np
 
-from catalogscanner.common import ASSET_PATH, FRAME_TYPE, ScanMode, ScanResult, read_json_asset
+from catalogscanner.common import (
+    ASSET_PATH,
+    FRAME_TYPE,
+    ScanMode,
+    ScanResult,
+    count,
+    read_image_pack,
+    read_json_asset,
+    stage,
+)
+from catalogscanner.frames import FrameSampler, FrameSource, open_frames
+from catalogscanner.segments import map_segments
 
 # The expected color for the video background.
 BG_COLOR = (194, 222, 228)
@@ -26,13 +37,18 @@ CONFUSED_ITEMS = {
 
 RECIPE_PATH = ASSET_PATH / "recipes"
 
+# Size of the downsampled recipe images compared to shortlist the candidates of a card.
+SIGNATURE_SIZE = 16
+
+# Number of candidates compared at full resolution, at least 2 to tell whether the match is obvious.
+SHORTLIST_SIZE = 8
+
 
 class RecipeCard:
     """The image and data associated with a given recipe."""
 
-    def __init__(self, item_name: str, filename: str, color_id: int) -> None:
-        img_path = RECIPE_PATH / "generated" / filename
-        self.img = cv2.imread(str(img_path))
+    def __init__(self, item_name: str, filename: str, color_id: int, img: FRAME_TYPE) -> None:
+        self.img = img
         self.name = item_name
         self.color_id = color_id
 
@@ -40,6 +56,46 @@ class RecipeCard:
         return f"RecipeCard({self.name!r}, {self.color_id!r})"
 
 
+class RecipeTable:
+    """The recipe database stacked into arrays, to select the candidates of many cards at once."""
+
+    def __init__(
+        self, recipes: List[RecipeCard], images: np.ndarray, color_db: Dict[int, Tuple[int, int, int]]
+    ) -> None:
+        self.recipes = recipes
+        self.images = images  # The image of each recipe, by index.
+        self.signatures = _signatures(images)
+
+        self.color_ids = np.array(list(color_db))
+        self.colors = np.array(list(color_db.values()), dtype=np.float64)
+        color_recipes = collections.defaultdict(list)
+        for i, recipe in enumerate(recipes):
+            color_recipes[recipe.color_id].append(i)
+        self.color_recipes = [np.array(color_recipes[color_id], dtype=np.intp) for color_id in color_db]
+
+    def candidates(self, cards: np.ndarray) -> List[np.ndarray]:
+        """Guesses the recipe color of each card and returns the indexes of all recipes the card could be."""
+        # Cut a small piece from the corner and calculate the average color.
+        bg_colors = cards[:, 104:107, 62:66, :].mean(axis=(1, 2))
+
+        # Calculate how close each color is to the card's background color.
+        distances = np.linalg.norm(bg_colors[:, None] - self.colors, axis=2)
+        candidates = []
+        for card_distances in distances:
+            order = np.lexsort((self.color_ids, card_distances))
+            # Stop at the candidates much worse than best candidate.
+            close = order[card_distances[order] - card_distances[order[0]] <= 10]
+            candidates.append(np.concatenate([self.color_recipes[i] for i in close]))
+        return candidates
+
+    def shortlist(self, card: FRAME_TYPE, candidates: np.ndarray, size: int) -> np.ndarray:
+        """Returns the candidates with the closest signatures to the card, closest first."""
+        _, nearest = cv2.batchDistance(
+            _signatures(card[None]), self.signatures[candidates], cv2.CV_32S, normType=cv2.NORM_L1, K=size
+        )
+        return candidates[nearest[0]]  # type: ignore[no-any-return]
+
+
 def detect(frame: FRAME_TYPE) -> bool:
     """Detects if a given frame is showing DIY recipes."""
     color = frame[:20, 1200:1240].mean(axis=(0, 1))
@@ -50,10 +106,13 @@ def detect(frame: FRAME_TYPE) -> bool:
     return np.linalg.norm(color - BG_COLOR) < 10  # type: ignore[return-value]
 
 
-def scan(video_file: Path, locale: str = "en-us") -> ScanResult:
+def scan(video_file: Path | FrameSource, locale: str = "en-us", jobs: int = 1) -> ScanResult:
     """Scans a video of scrolling through recipes list and returns all recipes found."""
-    recipe_cards = parse_video(video_file)
-    recipe_names = match_recipes(recipe_cards)
+    with stage("parse"):
+        recipe_cards = parse_video(video_file, jobs)
+    count("cards", len(recipe_cards))
+    with stage("match"):
+        recipe_names = match_recipes(recipe_cards)
     results = translate_names(recipe_names, locale)
 
     return ScanResult(
@@ -63,31 +122,55 @@ def scan(video_file: Path, locale: str = "en-us") -> ScanResult:
     )
 
 
-def parse_video(filename: Path) -> List[FRAME_TYPE]:
-    """Parses a whole video and returns images for all recipe cards found."""
+def parse_video(filename: Path | FrameSource, jobs: int = 1) -> List[FRAME_TYPE]:
+    """Parses a whole video and returns images for all recipe cards found.
+
+    With more than one job, segments of the video are parsed in parallel processes.
+    """
     all_cards: List[FRAME_TYPE] = []
-    for i, frame in enumerate(_read_frames(filename)):
-        if i % 4 != 0:
-            continue  # Skip every 4th frame
+    for replaced, cards in map_segments(_parse_segment, filename, jobs):
+        # Cards seen again at the start of a segment replace the last ones of the previous segment.
+        for offset, card in replaced.items():
+            all_cards[-offset] = card
+        all_cards.extend(cards)
+    return all_cards
+
+
+def _parse_segment(filename: Path | FrameSource, first: int) -> Tuple[Dict[int, FRAME_TYPE], List[FRAME_TYPE]]:
+    """Parses the frames of a video (segment) and returns images for all recipe cards found from frame `first` on.
+
+    Cards found before the first frame only tell which cards were seen last. Those
+    replaced by frames from the first one on are returned too, by their offset from the end.
+    """
+    all_cards: List[FRAME_TYPE] = []
+    seen: List[FRAME_TYPE] = []
+    for index, frame in _read_frames(filename, stride=4):
         for new_cards in _parse_frame(frame):
             if _is_duplicate_cards(all_cards, new_cards):
                 continue  # Skip non-moving frames
             all_cards.extend(new_cards)
-    return all_cards
+        if index < first:
+            seen = list(all_cards)
+
+    replaced = {len(seen) - i: card for i, (card, old) in enumerate(zip(all_cards, seen)) if card is not old}
+    return replaced, all_cards[len(seen) :]
 
 
 def match_recipes(recipe_cards: List[FRAME_TYPE]) -> List[str]:
     """Matches icons against database of recipe images, finding best matches."""
-    matched_recipes = set()
-    for card in recipe_cards:
-        # Check if the card is just the background color.
-        card_center_color = card[28:84, 28:84].mean(axis=(0, 1))
-        if np.linalg.norm(card_center_color - BG_COLOR) < 5:
-            continue  # Skip blank card slots.
+    if not recipe_cards:
+        return []
+
+    # Check if the cards are just the background color, to skip blank card slots.
+    cards = np.stack(recipe_cards)
+    card_center_colors = cards[:, 28:84, 28:84].mean(axis=(1, 2))
+    cards = cards[np.linalg.norm(card_center_colors - BG_COLOR, axis=1) >= 5]
 
-        possible_recipes = list(_get_candidate_recipes(card))
-        best_match = _find_best_match(card, possible_recipes)
-        item_name = best_match.name
+    matched_recipes: Set[str] = set()
+    recipe_table = _get_recipe_table()
+    for card, candidates in zip(cards, recipe_table.candidates(cards)):
+        best_match = _find_best_match(card, recipe_table, candidates)
+        item_name = recipe_table.recipes[best_match].name
 
         # If the item is already in our list, it might be confused with a similar item.
         if item_name in matched_recipes and item_name in CONFUSED_ITEMS:
@@ -107,22 +190,20 @@ def translate_names(recipe_names: List[str], locale: str) -> List[str]:
     return [translations[name][locale] for name in recipe_names]
 
 
-def _read_frames(filename: Path) -> Iterable[FRAME_TYPE]:
-    """Parses frames of the given video and returns the relevant region."""
-    cap = cv2.VideoCapture(filename)  # type: ignore[call-overload]
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # Video is over
+def _read_frames(filename: Path | FrameSource, stride: int = 1) -> Iterable[Tuple[int, FRAME_TYPE]]:
+    """Parses frames of the given video and returns the index and relevant region of every `stride`-th frame."""
+    # Frames in between are never retrieved from the decoder.
+    sampler = FrameSampler(stride)
+    with open_frames(filename) as frames:
+        for frame in frames.sample(sampler):
+            assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
 
-        assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
+            if not detect(frame):
+                continue  # Skip frames that are not showing recipes.
+            sampler.start()  # Only sample frames once recipes are showing.
 
-        if not detect(frame):
-            continue  # Skip frames that are not showing recipes.
-
-        # Crop the region containing recipe cards.
-        yield frame[110:720, 45:730]
-    cap.release()
+            # Crop the region containing recipe cards.
+            yield sampler.position, frame[110:720, 45:730]
 
 
 def _parse_frame(frame: FRAME_TYPE) -> Iterable[List[FRAME_TYPE]]:
@@ -178,8 +259,25 @@ def _is_duplicate_cards(all_cards: List[FRAME_TYPE], new_cards: List[FRAME_TYPE]
 
 
 @functools.lru_cache()
-def _get_recipe_db() -> Dict[int, List[RecipeCard]]:
-    """Fetches the item database for a given locale, with caching."""
+def _get_recipes() -> List[RecipeCard]:
+    """Fetches the recipes in the order of their images, with caching."""
+    images = _get_recipe_images()
+    return [RecipeCard(*recipe_data, img) for recipe_data, img in zip(_get_recipe_data(), images)]
+
+
+@functools.lru_cache()
+def _get_recipe_images() -> np.ndarray:
+    """Fetches the recipe images stacked into one array, with caching."""
+    return read_image_pack(RECIPE_PATH, _get_image_filenames())
+
+
+def _get_image_filenames() -> List[str]:
+    """Lists the recipe images, including the alternate ones."""
+    return [filename for _, filename, _ in _get_recipe_data()]
+
+
+def _get_recipe_data() -> List[Tuple[str, str, int]]:
+    """Reads the name, image and color of all recipes."""
     recipes_data = read_json_asset(RECIPE_PATH / "names.json")
 
     # Some recipes have alternate images, append those to the list.
@@ -188,11 +286,15 @@ def _get_recipe_db() -> Dict[int, List[RecipeCard]]:
         for name, filename, color in recipes_data
         if filename.endswith("_0_0.png")
     )
+    return recipes_data  # type: ignore[no-any-return]
 
+
+@functools.lru_cache()
+def _get_recipe_db() -> Dict[int, List[RecipeCard]]:
+    """Fetches the item database for a given locale, with caching."""
     recipe_db = collections.defaultdict(list)
-    for item_name, filename, card_color in recipes_data:
-        recipe = RecipeCard(item_name, filename, card_color)
-        recipe_db[card_color].append(recipe)
+    for recipe in _get_recipes():
+        recipe_db[recipe.color_id].append(recipe)
     return recipe_db
 
 
@@ -203,47 +305,61 @@ def _get_color_db() -> Dict[int, Tuple[int, int, int]]:
     return {int(color_id): (b, g, r) for color_id, (r, g, b) in colors_data.items()}
 
 
-def _get_candidate_recipes(card: FRAME_TYPE) -> Iterable[RecipeCard]:
-    """Guesses the recipe color and returns all recipes the card could be"""
-    color_db = _get_color_db()
-    recipe_db = _get_recipe_db()
-
-    # Cut a small piece from the corner and calculate the average color.
-    bg_color = card[104:107, 62:66, :].mean(axis=(0, 1))
-
-    # Calculate how close each color is to the card's background color.
-    distance_func = lambda x: np.linalg.norm(bg_color - color_db[x])  # noqa: E731
-    color_distances = sorted((distance_func(c), c) for c in color_db)  # type: ignore[no-untyped-call]
-    for distance, color_id in color_distances:
-        # Stop if the candidate is much worse than best candidate.
-        if distance - color_distances[0][0] > 10:
-            break
-        yield from recipe_db[color_id]
-
-
-def _find_best_match(card: FRAME_TYPE, recipes: List[RecipeCard]) -> RecipeCard:
-    """Finds the closest matching recipe for the given card."""
-    if len(recipes) == 1:
-        return recipes[0]
-
-    fast_similarity_metric = lambda r: cv2.absdiff(card, r.img).mean()  # noqa: E731
-    similarities = list(map(fast_similarity_metric, recipes))
-    sim1, sim2 = np.partition(similarities, kth=min(2, len(recipes) - 1))[:2]
+@functools.lru_cache()
+def _get_recipe_table() -> RecipeTable:
+    """Indexes the recipe database by color for matching, with caching."""
+    return RecipeTable(_get_recipes(), _get_recipe_images(), _get_color_db())
+
+
+def _find_best_match(
+    card: FRAME_TYPE, recipe_table: RecipeTable, candidates: np.ndarray, shortlist_size: int = SHORTLIST_SIZE
+) -> int:
+    """Finds the index of the closest matching recipe of the candidates for the given card."""
+    if len(candidates) == 1:
+        count("matches_fast")
+        return int(candidates[0])
+
+    # Only compare the candidates that look alike at a low resolution, in their original order.
+    shortlist = None
+    if len(candidates) > shortlist_size:
+        shortlist = recipe_table.shortlist(card, candidates, shortlist_size)
+        candidates = candidates[np.isin(candidates, shortlist)]
+    images = recipe_table.images[candidates]
+
+    fast_similarity_metric = lambda img: cv2.absdiff(card, img).mean()  # noqa: E731
+    similarities = list(map(fast_similarity_metric, images))
+    sim1, sim2 = np.partition(similarities, kth=min(2, len(images) - 1))[:2]
 
     # If the match seems obvious, return the quick result.
     if abs(sim1 - sim2) > 3:
-        return recipes[np.argmin(similarities)]
-
-    # Otherwise, we use a slower matching, which tries various shifts.
-    def slow_similarity_metric(recipe: RecipeCard) -> float:
-        diffs = []
-        for y in [-2, -1, 0, 1, 2]:
-            shifted = np.roll(card, y, axis=0)
-            diffs.append(cv2.absdiff(shifted, recipe.img).sum())
-        return min(diffs)  # type: ignore[no-any-return]  # Return lowest diff across shifts.
-
-    similarities = list(map(slow_similarity_metric, recipes))
-    return recipes[np.argmin(similarities)]
+        count("matches_fast")
+        best_match = int(candidates[np.argmin(similarities)])
+    else:
+        # Otherwise, we use a slower matching, which tries various shifts.
+        count("matches_slow")
+
+        def slow_similarity_metric(img: FRAME_TYPE) -> float:
+            diffs = []
+            for y in [-2, -1, 0, 1, 2]:
+                shifted = np.roll(card, y, axis=0)
+                diffs.append(cv2.absdiff(shifted, img).sum())
+            return min(diffs)  # type: ignore[no-any-return]  # Return lowest diff across shifts.
+
+        similarities = list(map(slow_similarity_metric, images))
+        best_match = int(candidates[np.argmin(similarities)])
+
+    if shortlist is not None:
+        # How often the closest signature is the match tells whether the shortlist could be shorter.
+        count("shortlists")
+        count("shortlist_hits", int(best_match == shortlist[0]))
+    return best_match
+
+
+def _signatures(images: np.ndarray) -> np.ndarray:
+    """Downsamples the images and flattens them into rows of signatures."""
+    size = (SIGNATURE_SIZE, SIGNATURE_SIZE)
+    signatures = [cv2.resize(image, size, interpolation=cv2.INTER_AREA) for image in images]
+    return np.stack(signatures).reshape(len(images), -1)
 
 
 if __name__ == "__main__":
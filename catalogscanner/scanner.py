@@ -4,58 +4,139 @@
 # Copyright (c) 2024 Nachtalb
 # This file contains both MIT and LGPL-3.0-or-later licensed code.
 import argparse
+import concurrent.futures
+import importlib
+import json
 import logging
+import sys
+import time
 from pathlib import Path
-from typing import Any, Dict
+from types import ModuleType
+from typing import Any, Dict, Iterator, List, Mapping, Optional
 
 import cv2
 
-from catalogscanner import catalog, critters, music, reactions, recipes, storage
-from catalogscanner.common import ScanResult
+from catalogscanner.cache import DEFAULT_MAX_SIZE, ResultCache, RowTextCache, file_digest
+from catalogscanner.common import LOCALE_MAP, ScanResult, collect_stats, stage
+from catalogscanner.frames import BACKENDS, FrameSource
 
-SCANNERS: Dict[str, Any] = {
-    "catalog": catalog,
-    "recipes": recipes,
-    "critters": critters,
-    "reactions": reactions,
-    "music": music,
-    "storage": storage,
-}
+
+class ScannerRegistry(Mapping[str, ModuleType]):
+    """Maps scan modes to their scanner modules, importing each module on first use."""
+
+    def __init__(self, modules: Dict[str, str]) -> None:
+        self._modules = modules
+
+    def __getitem__(self, mode: str) -> ModuleType:
+        return importlib.import_module(self._modules[mode])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._modules)
+
+    def __len__(self) -> int:
+        return len(self._modules)
+
+
+# Detection tries the scanners in this order.
+SCANNERS = ScannerRegistry(
+    {
+        "catalog": "catalogscanner.catalog",
+        "recipes": "catalogscanner.recipes",
+        "critters": "catalogscanner.critters",
+        "reactions": "catalogscanner.reactions",
+        "music": "catalogscanner.music",
+        "storage": "catalogscanner.storage",
+    }
+)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 
-def scan_media(filename: Path, mode: str = "auto", locale: str = "auto", for_sale: bool = False) -> ScanResult:
+# Scanners that can parse segments of a video in parallel.
+SEGMENTED_MODES = ["catalog", "recipes", "music"]
+
+# File types picked up when scanning a whole directory.
+MEDIA_SUFFIXES = [".jpg", ".jpeg", ".mp4"]
+
+
+def scan_media(
+    filename: Path,
+    mode: str = "auto",
+    locale: str = "auto",
+    for_sale: bool = False,
+    backend: str = "opencv",
+    jobs: int = 1,
+    cache: Optional[ResultCache] = None,
+    digest: Optional[str] = None,
+    ocr_cache: Optional[RowTextCache] = None,
+    stream: bool = False,
+) -> ScanResult:
+    """Scans a media file, see `main` for the options.
+
+    With a `cache`, results are looked up by the sha256 `digest` of the file
+    (computed if not given) and the scan options before scanning. With an
+    `ocr_cache`, catalog rows already seen are not OCR'd again. Timings and
+    counters of the scan are collected in `ScanResult.stats`.
+    """
     if "%d" not in filename.name and not filename.is_file():
         raise FileNotFoundError("File not found: %r" % filename)
 
-    if mode == "auto":
-        mode = _detect_media_type(filename)
-        logging.info("Detected scan mode: %s", mode)
+    key = None
+    if cache is not None and "%d" not in filename.name:  # Image sequences are not cached
+        key = cache.key(digest or file_digest(filename), mode, locale, for_sale)
+        if (result := cache.get(key)) is not None:
+            logging.info("Using cached result for %s", filename.name)
+            result.stats.count("cache_hits")
+            return result
 
-    if mode not in SCANNERS:
-        raise RuntimeError("Invalid mode: %r" % mode)
+    with collect_stats() as stats:
+        result = _scan(filename, mode, locale, for_sale, backend, jobs, ocr_cache, stream)
+    result.stats = stats
+    if cache is not None and key is not None:
+        cache.put(key, result)
+    return result
 
-    assert mode != "storage", "Storage scanning is not supported."
 
-    kwargs = {}
-    if mode == "catalog":
-        kwargs["for_sale"] = for_sale
+def _scan(
+    filename: Path,
+    mode: str,
+    locale: str,
+    for_sale: bool,
+    backend: str,
+    jobs: int,
+    ocr_cache: Optional[RowTextCache],
+    stream: bool,
+) -> ScanResult:
+    # The frames decoded for detection are replayed to the scanner instead of decoding them again. Without
+    # detection, only the region of the frames the scanner looks at is decoded.
+    region = getattr(SCANNERS[mode], "FRAME_REGION", None) if mode in SCANNERS else None
+    with FrameSource(filename, backend=backend, region=region) as frames:
+        if mode == "auto":
+            with stage("detect"):
+                mode = _detect_media_type(frames)
+            logging.info("Detected scan mode: %s", mode)
 
-    return SCANNERS[mode].scan(filename, locale=locale, **kwargs)  # type: ignore[no-any-return]
+        if mode not in SCANNERS:
+            raise RuntimeError("Invalid mode: %r" % mode)
 
+        assert mode != "storage", "Storage scanning is not supported."
 
-def _detect_media_type(filename: Path) -> str:
-    video_capture = cv2.VideoCapture(filename)  # type: ignore[call-overload]
+        kwargs: Dict[str, Any] = {}
+        if mode == "catalog":
+            kwargs["for_sale"] = for_sale
+            kwargs["ocr_cache"] = ocr_cache
+            kwargs["stream"] = stream
+        if mode in SEGMENTED_MODES:
+            kwargs["jobs"] = jobs
 
-    # Check the first 100 frames for a match.
-    for _ in range(100):
-        success, frame = video_capture.read()
-        if not success or frame is None:
-            break
+        return SCANNERS[mode].scan(frames, locale=locale, **kwargs)  # type: ignore[no-any-return]
 
+
+def _detect_media_type(frames: FrameSource) -> str:
+    # Check the first 100 frames for a match.
+    for frame in frames.peek(100):
         # Resize 1080p screenshots to 720p to match videos.
-        if filename.suffix == ".jpg" and frame.shape[:2] == (1080, 1920):
+        if frames.filename.suffix == ".jpg" and frame.shape[:2] == (1080, 1920):
             frame = cv2.resize(frame, (1280, 720))
 
         assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
@@ -67,12 +148,68 @@ def _detect_media_type(filename: Path) -> str:
     raise AssertionError("Media is not showing a known scan type.")
 
 
+def collect_media(paths: List[Path]) -> List[Path]:
+    """Expands directories to the media files in them, other paths are kept as is."""
+    media: List[Path] = []
+    for path in paths:
+        if path.is_dir():
+            media.extend(sorted(file for file in path.rglob("*") if file.suffix.lower() in MEDIA_SUFFIXES))
+        else:
+            media.append(path)
+    return media
+
+
+def scan_batch(filenames: List[Path], jobs: int = 1, **kwargs: Any) -> Iterator[Dict[str, Any]]:
+    """Scans many files in a pool of worker processes, yields a report for each file as it finishes.
+
+    Workers are reused between files, so the item databases they load stay cached.
+    """
+    if jobs <= 1:
+        for filename in filenames:
+            yield scan_report(filename, kwargs)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(scan_report, filename, kwargs) for filename in filenames]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def scan_report(filename: Path, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Scans a single file for a batch or service, errors are reported instead of raised."""
+    report: Dict[str, Any] = {"file": str(filename)}
+    start = time.perf_counter()
+    try:
+        result = scan_media(filename, **kwargs)
+    except AssertionError as e:
+        report["error"] = str(e)  # Media the scanners don't support
+    except Exception as e:
+        logging.exception("Failed to scan %s", filename)
+        report["error"] = f"{type(e).__name__}: {e}"
+    else:
+        report["mode"] = result.mode.name.lower()
+        report["locale"] = result.locale
+        report["items"] = result.items
+        report["unmatched"] = result.unmatched
+        report["stats"] = result.stats.to_json()
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Item scanner configuration")
-    parser.add_argument("media", type=Path, help="The media file to scan.")
+    parser.add_argument(
+        "media",
+        type=Path,
+        nargs="+",
+        help="The media file to scan. With several files or a directory, one JSON line is printed per file.",
+    )
 
     parser.add_argument(
-        "--locale", choices=list(catalog.LOCALE_MAP), default="auto", help="The locale to use for parsing item names."
+        "--locale",
+        choices=list(LOCALE_MAP),
+        default="auto",
+        help="The locale to use for parsing item names.",
     )
 
     parser.add_argument(
@@ -86,19 +223,71 @@ def main() -> None:
         help="The type of catalog to scan. Auto tries to detect from the media frames.",
     )
 
+    parser.add_argument(
+        "--backend", choices=list(BACKENDS), default="opencv", help="The backend used to decode the media frames."
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help=(
+            "Number of parallel processes. Files of a batch are scanned concurrently, a single long catalog, recipes"
+            " or music video is split into segments."
+        ),
+    )
+
+    parser.add_argument("--cache-dir", type=Path, help="Directory to cache scan results in, by file content.")
+
+    parser.add_argument(
+        "--cache-size", type=int, default=DEFAULT_MAX_SIZE // 1024**2, help="Maximum size of the result cache in MB."
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time spent in each stage of the scan and counters like the number of decoded frames.",
+    )
+
+    parser.add_argument(
+        "--ocr-cache-dir", type=Path, help="Directory to cache the OCR text of catalog rows in, by row image."
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="OCR catalog rows in batches while the video is still being parsed, instead of splitting it by --jobs.",
+    )
+
     args = parser.parse_args()
 
-    result = scan_media(
-        args.media,
+    cache = ResultCache(args.cache_dir, max_size=args.cache_size * 1024**2) if args.cache_dir else None
+    ocr_cache = RowTextCache(args.ocr_cache_dir) if args.ocr_cache_dir else None
+    options = dict(
         mode=args.mode,
         locale=args.locale,
         for_sale=args.for_sale,
+        backend=args.backend,
+        cache=cache,
+        ocr_cache=ocr_cache,
+        stream=args.stream,
     )
+    if len(args.media) > 1 or args.media[0].is_dir():
+        for report in scan_batch(collect_media(args.media), jobs=args.jobs, **options):
+            if not args.profile:
+                report.pop("stats", None)
+            print(json.dumps(report, ensure_ascii=False), flush=True)
+        return
+
+    result = scan_media(args.media[0], jobs=args.jobs, **options)
 
     result_count, result_mode = len(result.items), result.mode.name.lower()
     print(f"Found {result_count} items in {result_mode} [{result.locale}]")
     print("\n".join(result.items))
 
+    if args.profile:
+        print(result.stats.format(), file=sys.stderr)
+
 
 if __name__ == "__main__":
     main()
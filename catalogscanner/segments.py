@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+import concurrent.futures
+import logging
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+from catalogscanner.common import ScanStats, collect_stats, current_stats
+from catalogscanner.frames import REGION_TYPE, FrameBackend, FrameSource, count_frames, open_frames
+
+T = TypeVar("T")
+
+# Number of frames each segment re-reads from the end of the previous one. The
+# scanner only uses them to get into the same state (last page seen, scroll
+# position) the previous segment ended in, their results are dropped.
+SEGMENT_OVERLAP = 30
+
+# Segments shorter than this cost more in process startup than they save.
+MIN_SEGMENT_FRAMES = 120
+
+
+def split_segments(frame_count: int, jobs: int) -> list[tuple[int, int]]:
+    """Splits a video into up to `jobs` consecutive frame ranges."""
+    count = max(1, min(jobs, frame_count // MIN_SEGMENT_FRAMES))
+    bounds = [round(i * frame_count / count) for i in range(count + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def map_segments(
+    func: Callable[..., T], media: Path | FrameSource, jobs: int, *args: Any, region: Optional[REGION_TYPE] = None
+) -> list[T]:
+    """Calls `func(frames, first, *args)` for segments of the video in parallel processes.
+
+    Each segment is decoded from `SEGMENT_OVERLAP` frames before `first`, the
+    index of its first frame. `func` has to drop what it finds in the frames
+    before `first`, so the results of all segments, in video order, add up to
+    those of a single run. With a single job, or a video too short to split,
+    `func` runs once in this process on the whole video. Segments decode only
+    the `region` of the frames, as does a source opened here, see `open_frames`.
+    """
+    frames = open_frames(media, region)
+    segments = split_segments(count_frames(frames.filename), jobs) if jobs > 1 else []
+    if len(segments) <= 1:
+        return [func(frames, 0, *args)]
+
+    # Workers decode their segment themselves, frames buffered for detection are not needed.
+    frames.close()
+    logging.info("Scanning %d segments of %s in parallel", len(segments), frames.filename.name)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(segments)) as pool:
+        futures = [
+            pool.submit(_run_segment, func, frames.filename, frames.backend, start, end, region, args)
+            for start, end in segments
+        ]
+        results = []
+        for future in futures:
+            result, stats = future.result()
+            current_stats().merge(stats)
+            results.append(result)
+        return results
+
+
+def _run_segment(
+    func: Callable[..., T],
+    filename: Path,
+    backend: str | Callable[[Path, Optional[REGION_TYPE]], FrameBackend],
+    start: int,
+    end: int,
+    region: Optional[REGION_TYPE],
+    args: tuple[Any, ...],
+) -> tuple[T, ScanStats]:
+    """Worker process entry point, runs `func` on the given range of frames and returns its stats too."""
+    with collect_stats() as stats:
+        start_frame = max(0, start - SEGMENT_OVERLAP)
+        with FrameSource(filename, backend=backend, start=start_frame, end=end, region=region) as frames:
+            return func(frames, start, *args), stats
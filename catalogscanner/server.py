@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (c) 2024 Nachtalb
+"""HTTP service scanning uploaded media with warm databases.
+
+    POST /scan?mode=auto&locale=auto&for_sale=0&filename=video.mp4  (media as request body)
+        -> 202 {"id": "<job id>", "status": "pending"}
+    GET /jobs/<job id>?wait=30
+        -> 200 {"id": ..., "status": "pending" | "running" | "done", "report": {...}}
+
+`wait` long-polls for up to that many seconds until the job is done. The
+report has the same fields as the JSON lines of a `catalogscanner` batch.
+"""
+
+import argparse
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+import time
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from catalogscanner import catalog, critters, music, ocr, reactions, recipes
+from catalogscanner.cache import ResultCache, RowTextCache
+from catalogscanner.common import LOCALE_MAP
+from catalogscanner.frames import BACKENDS
+from catalogscanner.scanner import MEDIA_SUFFIXES, SCANNERS, scan_report
+
+CHUNK_SIZE = 1024 * 1024
+
+# Longest a GET request may wait for a job to finish.
+MAX_WAIT = 60
+
+# Finished jobs are forgotten after this many seconds.
+JOB_TTL = 60 * 60
+
+CONTENT_TYPES = {"image/jpeg": ".jpg", "video/mp4": ".mp4"}
+
+
+@dataclasses.dataclass
+class Job:
+    id: str
+    status: str = "pending"
+    report: Optional[Dict[str, Any]] = None
+    finished: float = 0
+    done: threading.Event = dataclasses.field(default_factory=threading.Event)
+
+    def to_json(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {"id": self.id, "status": self.status}
+        if self.report is not None:
+            data["report"] = self.report
+        return data
+
+
+class ScanService:
+    """Runs scan jobs on a thread pool, so all jobs share the cached scanner databases."""
+
+    def __init__(
+        self,
+        workers: int = 2,
+        backend: str = "opencv",
+        cache: Optional[ResultCache] = None,
+        upload_dir: Optional[Path] = None,
+        ocr_cache: Optional[RowTextCache] = None,
+    ) -> None:
+        self.backend = backend
+        self.cache = cache
+        self.ocr_cache = ocr_cache
+        self.upload_dir = upload_dir
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ScanJob")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, filename: Path, digest: str, name: str, options: Dict[str, Any]) -> Job:
+        """Queues a scan of the uploaded file, which is deleted once scanned."""
+        job = Job(id=uuid.uuid4().hex)
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        options.update(backend=self.backend, cache=self.cache, digest=digest, ocr_cache=self.ocr_cache)
+        self._pool.submit(self._run, job, filename, name, options)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(cancel_futures=True)
+
+    def _run(self, job: Job, filename: Path, name: str, options: Dict[str, Any]) -> None:
+        job.status = "running"
+        try:
+            job.report = scan_report(filename, options) | {"file": name}
+        finally:
+            filename.unlink(missing_ok=True)
+            job.status = "done"
+            job.finished = time.monotonic()
+            job.done.set()
+
+    def _purge(self) -> None:
+        expired = time.monotonic() - JOB_TTL
+        for job_id in [job.id for job in self._jobs.values() if job.done.is_set() and job.finished < expired]:
+            del self._jobs[job_id]
+
+
+class ScanRequestHandler(BaseHTTPRequestHandler):
+    server: "ScanServer"
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/scan":
+            return self._send_error(HTTPStatus.NOT_FOUND, "Not found")
+
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        mode, locale = query.get("mode", "auto"), query.get("locale", "auto")
+        if mode not in ["auto"] + list(SCANNERS):
+            return self._send_error(HTTPStatus.BAD_REQUEST, "Invalid mode: %r" % mode)
+        if locale not in LOCALE_MAP:
+            return self._send_error(HTTPStatus.BAD_REQUEST, "Invalid locale: %r" % locale)
+
+        name = query.get("filename", "")
+        suffix = Path(name).suffix.lower() or CONTENT_TYPES.get(self.headers.get_content_type(), "")
+        if suffix not in MEDIA_SUFFIXES:
+            return self._send_error(
+                HTTPStatus.BAD_REQUEST, "Unsupported media, expected one of: %s" % ", ".join(MEDIA_SUFFIXES)
+            )
+
+        length = self.headers.get("Content-Length")
+        if not length or not length.isdigit():
+            return self._send_error(HTTPStatus.LENGTH_REQUIRED, "Content-Length is required")
+        if int(length) > self.server.max_upload_size:
+            return self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "File size is too large")
+
+        filename, digest = self._receive_file(int(length), suffix)
+        if filename is None:
+            return self._send_error(HTTPStatus.BAD_REQUEST, "Upload ended early")
+
+        options = dict(mode=mode, locale=locale, for_sale=query.get("for_sale", "0").lower() in ["1", "true"])
+        job = self.server.service.submit(filename, digest, name or filename.name, options)
+        self._send_json(HTTPStatus.ACCEPTED, job.to_json())
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path == "/health":
+            return self._send_json(HTTPStatus.OK, {"status": "ok"})
+        if not url.path.startswith("/jobs/"):
+            return self._send_error(HTTPStatus.NOT_FOUND, "Not found")
+
+        job = self.server.service.get(url.path.removeprefix("/jobs/"))
+        if job is None:
+            return self._send_error(HTTPStatus.NOT_FOUND, "Unknown job")
+
+        wait = parse_qs(url.query).get("wait", ["0"])[-1]
+        try:
+            job.done.wait(min(max(float(wait), 0), MAX_WAIT))
+        except ValueError:
+            return self._send_error(HTTPStatus.BAD_REQUEST, "Invalid wait: %r" % wait)
+        self._send_json(HTTPStatus.OK, job.to_json())
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.debug("%s - " + format, self.address_string(), *args)
+
+    def _receive_file(self, length: int, suffix: str) -> tuple[Optional[Path], str]:
+        """Streams the request body into a temporary file, hashing it on the way."""
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(suffix=suffix, dir=self.server.service.upload_dir, delete=False) as file:
+            while length > 0:
+                chunk = self.rfile.read(min(length, CHUNK_SIZE))
+                if not chunk:
+                    break
+                file.write(chunk)
+                digest.update(chunk)
+                length -= len(chunk)
+
+        path = Path(file.name)
+        if length > 0:
+            path.unlink()
+            return None, ""
+        return path, digest.hexdigest()
+
+    def _send_json(self, status: HTTPStatus, data: Dict[str, Any]) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: HTTPStatus, message: str) -> None:
+        self._send_json(status, {"error": message})
+
+
+class ScanServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: ScanService, max_upload_size: int) -> None:
+        super().__init__(address, ScanRequestHandler)
+        self.service = service
+        self.max_upload_size = max_upload_size
+
+
+def warm_up() -> None:
+    """Loads all scanner databases and OCR engines, so the first requests don't pay for it."""
+    catalog._get_item_index()
+    for lang in sorted(set(LOCALE_MAP.values()) - {"auto"}) + [catalog.LATIN_LANG, catalog.NON_LATIN_LANG]:
+        ocr.warm_up(lang, variables=catalog._get_tesseract_variables(lang))
+    for critter_type in critters.CritterType:
+        critters._get_critter_matcher(critter_type)
+    music._get_song_index()
+    reactions._get_reaction_db()
+    recipes._get_recipe_db()
+    recipes._get_recipe_table()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="HTTP service scanning uploaded media")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on.")
+    parser.add_argument("--workers", type=int, default=2, help="Number of media scanned at the same time.")
+    parser.add_argument(
+        "--backend", choices=list(BACKENDS), default="opencv", help="The backend used to decode the media frames."
+    )
+    parser.add_argument("--cache-dir", type=Path, help="Directory to cache scan results in, by file content.")
+    parser.add_argument(
+        "--ocr-cache-dir", type=Path, help="Directory to cache the OCR text of catalog rows in, by row image."
+    )
+    parser.add_argument("--max-upload-size", type=int, default=200, help="Maximum size of an upload in MB.")
+    args = parser.parse_args()
+
+    logging.info("Loading scanner databases and OCR engines...")
+    warm_up()
+
+    with tempfile.TemporaryDirectory(prefix="catalogscanner-") as upload_dir:
+        cache = ResultCache(args.cache_dir) if args.cache_dir else None
+        ocr_cache = RowTextCache(args.ocr_cache_dir) if args.ocr_cache_dir else None
+        service = ScanService(
+            workers=args.workers, backend=args.backend, cache=cache, upload_dir=Path(upload_dir), ocr_cache=ocr_cache
+        )
+        with ScanServer((args.host, args.port), service, args.max_upload_size * 1024**2) as server:
+            logging.info("Listening on http://%s:%d", args.host, args.port)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                print("Exiting...")
+            finally:
+                service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
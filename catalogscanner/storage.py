@@ -4,12 +4,14 @@
 # Copyright (c) 2024 Nachtalb
 # This file contains both MIT and LGPL-3.0-or-later licensed code.
 from pathlib import Path
-from typing import Iterator, List
+from typing import Dict, Iterator, List, Tuple
 
 import cv2
 import numpy as np
 
-from catalogscanner.common import FRAME_TYPE, ScanMode, ScanResult
+from catalogscanner.common import FRAME_TYPE, ScanMode, ScanResult, count, stage
+from catalogscanner.frames import FrameSampler, FrameSource, open_frames
+from catalogscanner.segments import map_segments
 
 # The expected color for the video background.
 BG_COLOR = (69, 198, 246)
@@ -24,10 +26,13 @@ def detect(frame: FRAME_TYPE) -> bool:
     return np.linalg.norm(color - BG_COLOR) < 5  # type: ignore[return-value]
 
 
-def scan(video_file: Path, locale: str = "en-us") -> ScanResult:
+def scan(video_file: Path | FrameSource, locale: str = "en-us", jobs: int = 1) -> ScanResult:
     """Scans a video of scrolling through storage returns all items found."""
-    item_images = parse_video(video_file)
-    item_names = match_items(item_images)
+    with stage("parse"):
+        item_images = parse_video(video_file, jobs)
+    count("items", len(item_images))
+    with stage("match"):
+        item_names = match_items(item_images)
     results = translate_names(item_names, locale)
 
     return ScanResult(
@@ -37,17 +42,38 @@ def scan(video_file: Path, locale: str = "en-us") -> ScanResult:
     )
 
 
-def parse_video(filename: Path) -> List[FRAME_TYPE]:
-    """Parses a whole video and returns images for all storage items found."""
+def parse_video(filename: Path | FrameSource, jobs: int = 1) -> List[FRAME_TYPE]:
+    """Parses a whole video and returns images for all storage items found.
+
+    With more than one job, segments of the video are parsed in parallel processes.
+    """
     all_rows: List[FRAME_TYPE] = []
-    for i, frame in enumerate(_read_frames(filename)):
-        if i % 4 != 0:
-            continue  # Skip every 4th frame
+    for replaced, rows in map_segments(_parse_segment, filename, jobs):
+        # Rows seen again at the start of a segment replace the last ones of the previous segment.
+        for offset, item in replaced.items():
+            all_rows[-offset] = item
+        all_rows.extend(rows)
+    return _remove_blanks(all_rows)
+
+
+def _parse_segment(filename: Path | FrameSource, first: int) -> Tuple[Dict[int, FRAME_TYPE], List[FRAME_TYPE]]:
+    """Parses the frames of a video (segment) and returns images for all storage items found from frame `first` on.
+
+    Items found before the first frame only tell which rows were seen last. Those
+    replaced by frames from the first one on are returned too, by their offset from the end.
+    """
+    all_rows: List[FRAME_TYPE] = []
+    seen: List[FRAME_TYPE] = []
+    for index, frame in _read_frames(filename, stride=4):
         for new_row in _parse_frame(frame):
             if _is_duplicate_row(all_rows, new_row):
                 continue  # Skip non-moving frames
             all_rows.extend(new_row)
-    return _remove_blanks(all_rows)
+        if index < first:
+            seen = list(all_rows)
+
+    replaced = {len(seen) - i: item for i, (item, old) in enumerate(zip(all_rows, seen)) if item is not old}
+    return replaced, all_rows[len(seen) :]
 
 
 def match_items(item_images: List[FRAME_TYPE]) -> List[str]:
@@ -62,22 +88,20 @@ def translate_names(item_names: List[str], locale: str) -> List[str]:
     return item_names
 
 
-def _read_frames(filename: Path) -> Iterator[FRAME_TYPE]:
-    """Parses frames of the given video and returns the relevant region."""
-    cap = cv2.VideoCapture(filename)  # type: ignore[call-overload]
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # Video is over
-
-        assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
+def _read_frames(filename: Path | FrameSource, stride: int = 1) -> Iterator[Tuple[int, FRAME_TYPE]]:
+    """Parses frames of the given video and returns the index and relevant region of every `stride`-th frame."""
+    # Frames in between are never retrieved from the decoder.
+    sampler = FrameSampler(stride)
+    with open_frames(filename) as frames:
+        for frame in frames.sample(sampler):
+            assert frame.shape[:2] == (720, 1280), "Invalid resolution: {1}x{0}".format(*frame.shape)
 
-        if not detect(frame):
-            continue  # Skip frames that are not showing storage.
+            if not detect(frame):
+                continue  # Skip frames that are not showing storage.
+            sampler.start()  # Only sample frames once storage is showing.
 
-        # Crop the region containing storage items.
-        yield frame[150:675, 112:1168]
-    cap.release()
+            # Crop the region containing storage items.
+            yield sampler.position, frame[150:675, 112:1168]
 
 
 def _parse_frame(frame: FRAME_TYPE) -> Iterator[List[FRAME_TYPE]]:
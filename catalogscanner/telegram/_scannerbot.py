@@ -14,6 +14,7 @@ from telegram.constants import ParseMode
 from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, ContextTypes, ExtBot, MessageHandler, filters
 
+from catalogscanner.cache import ResultCache
 from catalogscanner.common import ScanResult
 from catalogscanner.scanner import scan_media
 from catalogscanner.telegram.common import TG_MAX_DOWNLOAD_SIZE, sel
@@ -28,11 +29,13 @@ class ScannerBot:
         lock_to_admins: bool = True,
         local_mode: bool = False,
         hastebin_host: str = "https://bin.naa.gg/",
+        cache: ResultCache | None = None,
     ) -> None:
         self.logger = logging.getLogger(__name__)
         self.local_mode = local_mode
         self.admins = [int(admin) for admin in admins if isinstance(admin, int) or admin.isdigit()]
         self.lock_to_admins = lock_to_admins
+        self.cache = cache
 
         self.httpx_client: AsyncClient = None  # type: ignore[assignment]
         self.hastebin_host = hastebin_host.rstrip("/")
@@ -92,10 +95,11 @@ class ScannerBot:
 
         return file
 
-    async def download_file(self, file: File, destination: Path | None = None) -> Path:
+    async def download_file(self, file: File, destination: Path | None = None) -> tuple[Path, str | None]:
+        """Downloads the file, returns its path and sha256 digest (None for files already on disk)."""
         path = Path(file.file_path)  # type: ignore[arg-type]
         if self.local_mode and path.exists():
-            return path
+            return path, None
 
         if not destination:
             raise ValueError("Destination path is not provided")
@@ -106,9 +110,11 @@ class ScannerBot:
         hash = sha256(out.getvalue()).hexdigest()
         destination = destination / f"{hash}{path.suffix}"
         destination.write_bytes(out.getvalue())
-        return destination
+        return destination, hash
 
-    async def get_file(self, media: PhotoSize | Video | Document, destination: Path | None = None) -> Path:
+    async def get_file(
+        self, media: PhotoSize | Video | Document, destination: Path | None = None
+    ) -> tuple[Path, str | None]:
         file = await self.prepare_file_for_download(media)
         return await self.download_file(file, destination=destination)
 
@@ -122,11 +128,11 @@ class ScannerBot:
         answer = await update.message.reply_text("Processing media...", reply_to_message_id=reply_message_id)
 
         with TemporaryDirectory() as temp_dir:
-            path = await self.get_file(photo, destination=Path(temp_dir))
+            path, digest = await self.get_file(photo, destination=Path(temp_dir))
             self.logger.info(f"File saved at: {path}")
 
             try:
-                result = await self.scan_media(path)
+                result = await self.scan_media(path, digest)
             except AssertionError as e:
                 self.logger.error(f"Failed to scan media, error: {e}")
                 await answer.edit_text(f"Failed to scan media! {e.args[0]}")
@@ -165,8 +171,8 @@ class ScannerBot:
                 parse_mode=ParseMode.HTML,
             )
 
-    async def scan_media(self, path: Path) -> ScanResult:
-        return await asyncio.to_thread(scan_media, path)
+    async def scan_media(self, path: Path, digest: str | None = None) -> ScanResult:
+        return await asyncio.to_thread(scan_media, path, cache=self.cache, digest=digest)
 
     async def receive_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if not update.message or not update.effective_user:
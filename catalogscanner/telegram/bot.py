@@ -2,11 +2,13 @@
 # Copyright (c) 2024 Nachtalb
 import argparse
 import logging
+from pathlib import Path
 from uuid import uuid4
 
 from telegram import Update
 from telegram.ext import ApplicationBuilder, PicklePersistence
 
+from catalogscanner.cache import ResultCache
 from catalogscanner.telegram._scannerbot import ScannerBot
 from catalogscanner.telegram.common import TG_BASE_URL
 
@@ -21,6 +23,7 @@ def bot_main() -> None:
     parser.add_argument("--local-mode", action="store_true", help="Run the bot in local mode", default=False)
     parser.add_argument("--admins", help="List of admin ids, separated by commas.", default="")
     parser.add_argument("--lock", action="store_true", help="Lock the bot to the configured admins", default=False)
+    parser.add_argument("--cache-dir", type=Path, help="Directory to cache scan results in, by file content")
 
     sub_parsers = parser.add_subparsers()
     webhook_parser = sub_parsers.add_parser("webhook")
@@ -33,7 +36,8 @@ def bot_main() -> None:
 
     args = parser.parse_args()
 
-    bot = ScannerBot(admins=args.admins.split(","), local_mode=args.local_mode, lock_to_admins=args.lock)
+    cache = ResultCache(args.cache_dir) if args.cache_dir else None
+    bot = ScannerBot(admins=args.admins.split(","), local_mode=args.local_mode, lock_to_admins=args.lock, cache=cache)
 
     persistence = PicklePersistence(filepath="scanner_bot.dat")
     app = (
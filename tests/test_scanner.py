@@ -3,16 +3,34 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 # Copyright (c) 2024 Nachtalb
 # This file contains both MIT and LGPL-3.0-or-later licensed code.
+import difflib
 import json
-from contextlib import contextmanager
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import urllib.request
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
 from typing import Any, Generator
 from unittest import mock
 
+import cv2
+import numpy as np
 import pytest
 
-from catalogscanner import catalog, scanner
-from catalogscanner.common import ScanMode
+from catalogscanner import cache, catalog, critters, matching, music, ocr, recipes, scanner, server
+from catalogscanner.common import (
+    FRAME_TYPE,
+    LOCALE_MAP,
+    ROWS_TYPE,
+    ScanMode,
+    collect_stats,
+    read_image_pack,
+    write_image_pack,
+)
+from catalogscanner.frames import PEEK_BUFFER_SIZE, FrameSource
 
 TEST_ASSETS = Path(__file__).parent / "assets"
 
@@ -23,8 +41,11 @@ GROUND_TRUTH_EXTRAS = json.loads((TEST_ASSETS / "expected/extra.json").read_text
 
 @contextmanager
 def inject_catalog_words(words: list[str], locale: str = "en-us") -> Generator[None, None, None]:
-    db = catalog._get_item_db(locale) | set(words)
-    with mock.patch.object(catalog, "_get_item_db", return_value=db):
+    locales = [name for name in LOCALE_MAP if name != "auto"]
+    index = matching.ItemIndex.build(
+        {name: catalog._get_item_db(name) | (set(words) if name == locale else set()) for name in locales}
+    )
+    with mock.patch.object(catalog, "_get_item_index", return_value=index):
         yield
 
 
@@ -93,6 +114,12 @@ class TestScanner:
         assert results.items == GROUND_TRUTH["test_music_translate"]
         assert results.locale == "ja-jp"
 
+    def test_when_scan_media_given_auto_mode_then_decode_media_only_once(self) -> None:
+        with mock.patch.object(cv2, "VideoCapture", wraps=cv2.VideoCapture) as video_capture:
+            results = scanner.scan_media(TEST_ASSETS / "input/music.mp4")
+        video_capture.assert_called_once()
+        assert results.items == GROUND_TRUTH["test_music"]
+
 
 @pytest.mark.parametrize("filename", GROUND_TRUTH_EXTRAS.keys())
 def test_extra(filename: str) -> None:
@@ -103,3 +130,449 @@ def test_extra(filename: str) -> None:
     except AssertionError as e:
         actual = str(e)
     assert GROUND_TRUTH_EXTRAS[filename] == actual
+
+
+@pytest.mark.parametrize("backend", ["pyav", "ffmpeg"])
+def test_frame_backend(backend: str) -> None:
+    if backend == "pyav":
+        pytest.importorskip("av")
+    elif not shutil.which("ffmpeg"):
+        pytest.skip("ffmpeg is not installed")
+
+    results = scanner.scan_media(TEST_ASSETS / "input/music.mp4", backend=backend)
+    assert results.items == GROUND_TRUTH["test_music"]
+
+
+def test_when_frames_peeked_past_buffer_then_decode_them_again() -> None:
+    filename = TEST_ASSETS / "input/music.mp4"
+    with FrameSource(filename) as frames:
+        expected = [frame.copy() for frame in frames]
+
+    peek_count = PEEK_BUFFER_SIZE + 2
+    with FrameSource(filename) as frames:
+        peeked = [frame.copy() for frame in frames.peek(peek_count)]
+        assert not frames._buffer  # Nothing is kept once there are too many frames.
+        peeked_again = [frame.copy() for frame in frames.peek(3)]
+        frames_read = list(frames)
+    assert len(peeked) == peek_count and len(frames_read) == len(expected)
+    for actual, frame in zip(peeked + peeked_again + frames_read, expected[:peek_count] + expected[:3] + expected):
+        assert np.array_equal(actual, frame)
+
+
+@pytest.mark.parametrize("backend", ["opencv", "ffmpeg"])
+def test_when_frames_cropped_to_catalog_region_then_parse_the_same_rows(backend: str) -> None:
+    if backend == "ffmpeg" and not shutil.which("ffmpeg"):
+        pytest.skip("ffmpeg is not installed")
+
+    filename = TEST_ASSETS / "input/catalog.mp4"
+    expected = catalog.parse_video(FrameSource(filename))
+    with FrameSource(filename, backend=backend, region=catalog.FRAME_REGION) as frames:
+        assert next(iter(frames)).shape == (480, 646, 3)
+    rows = catalog.parse_video(FrameSource(filename, backend=backend, region=catalog.FRAME_REGION))
+    assert np.array_equal(rows, expected)
+
+
+def test_when_recipes_scan_given_jobs_then_parse_segments_in_parallel() -> None:
+    results = scanner.scan_media(TEST_ASSETS / "input/recipes.mp4", jobs=2)
+    assert results.mode == ScanMode.RECIPES
+    assert results.items == GROUND_TRUTH["test_recipes"]
+
+
+@pytest.mark.parametrize(
+    "module, filename",
+    [
+        (catalog, "catalog_twopage.mp4"),
+        (catalog, "catalog_badscroll.mp4"),
+        (recipes, "recipes_full.mp4"),
+        (music, "music_brown2.mp4"),
+    ],
+)
+def test_when_parse_video_given_jobs_then_match_single_job(module: Any, filename: str) -> None:
+    def parse(jobs: int) -> Any:
+        try:
+            return np.asarray(module.parse_video(TEST_ASSETS / "input/extra" / filename, jobs=jobs))
+        except AssertionError as e:
+            return str(e)
+
+    expected = parse(1)
+    for jobs in [2, 4]:
+        assert np.array_equal(parse(jobs), expected)
+
+
+def test_when_scan_batch_given_directory_then_report_every_file() -> None:
+    media = scanner.collect_media([TEST_ASSETS / "input"])
+    assert TEST_ASSETS / "input/extra/music_img.jpg" in media
+
+    media = [TEST_ASSETS / "input/music.mp4", TEST_ASSETS / "input/reactions.jpg", TEST_ASSETS / "input/storage.mp4"]
+    reports = {Path(report["file"]).name: report for report in scanner.scan_batch(media, jobs=2)}
+    assert reports["music.mp4"]["items"] == GROUND_TRUTH["test_music"]
+    assert reports["reactions.jpg"]["mode"] == "reactions"
+    assert reports["storage.mp4"]["error"] == "Storage scanning is not supported."
+    assert all("seconds" in report for report in reports.values())
+
+
+def test_when_scan_media_given_cache_then_reuse_result_of_same_content(tmp_path: Path) -> None:
+    result_cache = cache.ResultCache(tmp_path / "cache")
+    media = tmp_path / "copy.mp4"
+    shutil.copy(TEST_ASSETS / "input/music.mp4", media)
+
+    scanner.scan_media(TEST_ASSETS / "input/music.mp4", cache=result_cache)
+    with mock.patch.object(scanner, "_scan") as scan:
+        results = scanner.scan_media(media, cache=result_cache)
+    scan.assert_not_called()
+    assert results.mode == ScanMode.MUSIC
+    assert results.items == GROUND_TRUTH["test_music"]
+
+
+def test_when_server_given_upload_then_long_poll_scan_report(tmp_path: Path) -> None:
+    service = server.ScanService(workers=1, upload_dir=tmp_path)
+    with server.ScanServer(("127.0.0.1", 0), service, max_upload_size=10 * 1024**2) as http_server:
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:%d" % http_server.server_address[1]
+
+        upload = (TEST_ASSETS / "input/music.mp4").read_bytes()
+        with urllib.request.urlopen(urllib.request.Request(url + "/scan?filename=music.mp4", data=upload)) as response:
+            job = json.load(response)
+        with urllib.request.urlopen(url + "/jobs/%s?wait=60" % job["id"]) as response:
+            job = json.load(response)
+        http_server.shutdown()
+    service.shutdown()
+
+    assert job["status"] == "done"
+    assert job["report"]["file"] == "music.mp4"
+    assert job["report"]["items"] == GROUND_TRUTH["test_music"]
+    assert not list(tmp_path.iterdir())  # Uploads are deleted once scanned
+
+
+# About twice the CPU time importing the CLI takes, most of it is spent importing OpenCV and numpy. CPU rather than
+# wall time, so other processes running tests don't count.
+STARTUP_BUDGET = 0.5
+
+
+def test_when_scan_reactions_then_only_import_what_is_needed() -> None:
+    code = """
+import sys, time
+start = time.process_time()
+from catalogscanner import scanner
+print(time.process_time() - start)
+print(sorted(m for m in ["catalogscanner.catalog", "catalogscanner.ocr", "catalogscanner.recipes"] if m in sys.modules))
+scanner.scan_media(scanner.Path(sys.argv[1]), mode="reactions")
+print(sorted(m for m in ["pytesseract", "PIL", "imagehash", "catalogscanner.music"] if m in sys.modules))
+"""
+    process = subprocess.run(
+        [sys.executable, "-c", code, str(TEST_ASSETS / "input/reactions.jpg")],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_time, imported_on_start, imported = process.stdout.splitlines()
+    assert float(import_time) < STARTUP_BUDGET
+    assert imported_on_start == imported == "[]"
+
+
+def test_when_scan_media_then_collect_stage_timings_and_counters() -> None:
+    results = scanner.scan_media(TEST_ASSETS / "input/recipes.mp4")
+    assert {"detect", "decode", "parse", "match"} <= set(results.stats.timings)
+    assert results.stats.counters["frames_decoded"] + results.stats.counters["frames_skipped"] == 333
+    assert results.stats.counters["matches_fast"] + results.stats.counters["matches_slow"] > 0
+
+
+def test_when_ocr_engine_pool_given_same_language_then_reuse_engine() -> None:
+    pool = ocr.EnginePool(mock.Mock(wraps=ocr.OcrEngine))
+    with pool.engine("eng") as first, pool.engine("eng") as second:
+        assert first is not second  # Busy engines are never shared.
+    with pool.engine("eng") as third, pool.engine("jpn") as other:
+        assert third in (first, second)
+        assert other.lang == "jpn"
+    assert pool._engine.call_count == 3  # type: ignore[attr-defined]
+
+
+def test_when_run_ocr_given_large_catalog_then_split_into_concurrent_chunks() -> None:
+    rows: list[FRAME_TYPE] = [np.full((35, 415), 255, dtype=np.uint8)] * 2000
+    with mock.patch.object(ocr, "image_to_string", side_effect=lambda image, *args: f"{len(image) // 35} rows\n"):
+        assert catalog.run_ocr(rows, workers=4) == {"500 rows"}
+        assert catalog.run_ocr(rows, workers=1) == {"500 rows"}  # Still grouped by width.
+    assert [len(chunk) for chunk in ocr.split_chunks(rows, workers=1)] == [667, 667, 666]  # Below the 32k limit.
+
+
+def test_when_compact_rows_then_trim_and_binarize_rows_and_map_text_back() -> None:
+    rows = np.full((3, 35, 415), 230, dtype=np.uint8)
+    for i, width in enumerate([100, 300, 200]):
+        rows[i, 10:25, 5:width] = 80
+    compacted, order = ocr.compact_rows(rows)
+    assert [row.shape[1] for row in compacted] == [310, 210, 110] and order.tolist() == [1, 2, 0]
+    assert set(np.unique(compacted[0])) == {0, 255}
+
+    def recognize(image: np.ndarray) -> list[tuple[int, int, str]]:
+        # One line per row, telling the width of its text.
+        stacked = image.reshape(-1, 35, image.shape[1])
+        return [(35 * i + 10, 35 * i + 25, str((row == 0).sum() // 15)) for i, row in enumerate(stacked)]
+
+    pool = mock.Mock(engine=lambda *args: nullcontext(mock.Mock(image_to_lines=recognize)))
+    with mock.patch.object(ocr, "get_pool", return_value=pool):
+        assert ocr.image_rows_to_row_strings(rows, "eng", compact=True) == ["95", "295", "195"]
+
+
+def test_when_run_ocr_given_row_cache_then_only_recognize_new_rows(tmp_path: Path) -> None:
+    rows: list[FRAME_TYPE] = [np.full((35, 415), 255, dtype=np.uint8) for _ in range(3)]
+    for i, row in enumerate(rows):
+        row[10:25, 20 : 60 + 80 * i] = 0
+    row_cache = cache.RowTextCache(tmp_path)
+
+    def recognize(chunk: ROWS_TYPE, *args: object, **kwargs: object) -> list[str]:
+        return [f"Item {int((row == 0).sum())}" for row in chunk]
+
+    with mock.patch.object(ocr, "image_rows_to_row_strings", side_effect=recognize) as ocr_rows:
+        first = catalog.run_ocr(rows[:2], cache=row_cache)
+        second = catalog.run_ocr(rows, cache=row_cache)
+    assert first < second and len(second) == 3
+    assert [len(call.args[0]) for call in ocr_rows.call_args_list] == [2, 1]
+
+
+@pytest.mark.parametrize("locale", ["en-us", "ja-jp"])
+def test_when_item_index_given_noisy_names_then_match_like_difflib(locale: str) -> None:
+    item_db = catalog._get_item_db(locale)
+    index = catalog._get_item_index()
+    names = sorted(item_db)[::400]
+    words = [name[1:] + "l" for name in names] + [name.upper() for name in names] + ["", "xyz", "Chair"]
+    for word in words:
+        expected = difflib.get_close_matches(word, item_db, n=1, cutoff=0.5)
+        match = index.best_match(word, locale, cutoff=0.5)
+        assert ([match[0]] if match else []) == expected, word
+
+
+def test_when_item_index_missing_then_build_and_write_it_once(tmp_path: Path) -> None:
+    index_path = tmp_path / "index.bin"
+    catalog._get_item_index.cache_clear()
+    try:
+        with mock.patch.object(catalog, "ITEM_INDEX_PATH", index_path):
+            built = catalog._get_item_index()
+            assert index_path.exists() and list(tmp_path.iterdir()) == [index_path]
+
+            catalog._get_item_index.cache_clear()
+            with mock.patch.object(catalog, "_build_item_index") as build:
+                loaded = catalog._get_item_index()
+            build.assert_not_called()
+            assert loaded.locales == built.locales and len(loaded) == len(built)
+    finally:
+        catalog._get_item_index.cache_clear()
+
+
+def test_when_item_index_saved_then_load_it_memory_mapped(tmp_path: Path) -> None:
+    index = matching.ItemIndex.build({"en-us": ["Chair", "Table", "Ｔａｂｌｅ"], "de-eu": ["Stuhl", "Table"]})
+    index.save(tmp_path / "index.bin")
+    loaded = matching.ItemIndex.load(tmp_path / "index.bin")
+
+    assert loaded.locales == ["en-us", "de-eu"] and len(loaded) == 3
+    assert loaded.locale_mask("Table") == 0b11 and loaded.locale_mask("Stuhl") == 0b10
+    assert loaded.contains("Chair", "en-us") and not loaded.contains("Chair", "de-eu")
+    assert loaded.locale_mask("Tisch") == 0
+    assert loaded.names("en-us") == ["Chair", "Table"]
+    assert loaded.best_match("Stuh", "de-eu") == index.best_match("Stuh", "de-eu") == ("Stuhl", 8 / 9)
+    assert loaded.best_match("Stuh", "en-us") is None
+
+
+def test_when_detect_locale_given_latin_names_then_reuse_the_items_found() -> None:
+    rows: FRAME_TYPE = np.zeros((catalog.LOCALE_SAMPLE_SIZE, *catalog.ROW_SHAPE), dtype=np.uint8)
+    rows[:] = np.arange(catalog.LOCALE_SAMPLE_SIZE, dtype=np.uint8)[:, None, None]
+    de_names = sorted(catalog._get_item_db("de-eu") - catalog._get_item_db("en-us") - catalog._get_item_db("nl-eu"))
+
+    def recognize(chunk: ROWS_TYPE, lang: str, **kwargs: object) -> list[str]:
+        assert lang == catalog.LATIN_LANG
+        return [de_names[row[0, 0]] if row[0, 0] % 2 else "Unl3serlich" for row in chunk]
+
+    with mock.patch.object(ocr, "image_rows_to_row_strings", side_effect=recognize) as mock_ocr:
+        locale, known_names = catalog._detect_locale(rows, "auto")
+    assert mock_ocr.call_count == 1
+    assert locale == "de-eu"
+    assert len(known_names) == 15 and all(i % 2 and name == de_names[i] for i, name in known_names.items())
+
+
+def test_when_scan_given_only_rows_recognized_while_detecting_locale_then_skip_ocr() -> None:
+    rows: FRAME_TYPE = np.zeros((10, *catalog.ROW_SHAPE), dtype=np.uint8)
+    rows[:] = np.arange(10, dtype=np.uint8)[:, None, None]
+    en_names = sorted(catalog._get_item_db("en-us"))
+
+    def recognize(chunk: ROWS_TYPE, lang: str, **kwargs: object) -> list[str]:
+        return [en_names[row[0, 0]] for row in chunk]
+
+    with (
+        mock.patch.object(catalog, "parse_video", return_value=rows),
+        mock.patch.object(ocr, "image_rows_to_row_strings", side_effect=recognize),
+    ):
+        result = catalog.scan(TEST_ASSETS / "input/catalog.mp4", locale="auto")
+    assert result.locale == "en-us" and len(result.items) == 10
+
+
+def test_when_detect_locale_given_non_latin_names_then_only_ocr_with_their_language() -> None:
+    rows: FRAME_TYPE = np.zeros((catalog.LOCALE_SAMPLE_SIZE, *catalog.ROW_SHAPE), dtype=np.uint8)
+    ru_names = sorted(catalog._get_item_db("ru-eu"))
+
+    def recognize(chunk: ROWS_TYPE, lang: str, **kwargs: object) -> list[str]:
+        return [ru_names[0]] * len(chunk)
+
+    with mock.patch.object(ocr, "image_rows_to_row_strings", side_effect=recognize) as mock_ocr:
+        locale, known_names = catalog._detect_locale(rows, "auto")
+    assert [call.args[1] for call in mock_ocr.call_args_list] == [catalog.LATIN_LANG, catalog.NON_LATIN_LANG, "rus"]
+    assert len(mock_ocr.call_args_list[1].args[0]) == catalog.SCRIPT_SAMPLE_SIZE
+    assert mock_ocr.call_args_list[2].kwargs["variables"] == catalog._get_tesseract_variables("rus")
+    assert locale == "ru-eu" and len(known_names) == catalog.LOCALE_SAMPLE_SIZE
+
+
+def test_when_detect_locale_given_rows_split_between_scripts_then_try_all_other_languages() -> None:
+    rows: FRAME_TYPE = np.zeros((catalog.LOCALE_SAMPLE_SIZE, *catalog.ROW_SHAPE), dtype=np.uint8)
+    ru_name, ko_name = min(catalog._get_item_db("ru-eu")), min(catalog._get_item_db("ko-kr"))
+
+    def recognize(chunk: ROWS_TYPE, lang: str, **kwargs: object) -> list[str]:
+        if lang == catalog.NON_LATIN_LANG:
+            return [ru_name, ko_name] * (len(chunk) // 2)
+        return [ko_name if lang == "kor" else "???"] * len(chunk)
+
+    with mock.patch.object(ocr, "image_rows_to_row_strings", side_effect=recognize) as mock_ocr:
+        locale, _ = catalog._detect_locale(rows, "auto")
+    langs = ["jpn", "rus", "chi_sim", "chi_tra", "kor"]
+    assert [call.args[1] for call in mock_ocr.call_args_list] == [catalog.LATIN_LANG, catalog.NON_LATIN_LANG, *langs]
+    assert locale == "ko-kr"
+
+
+def test_when_classify_script_given_ocr_text_then_return_its_script() -> None:
+    assert catalog._classify_script("ドラム缶") == "Japanese"
+    assert catalog._classify_script("드럼통") == "Hangul"
+    assert catalog._classify_script("Бочка") == "Cyrillic"
+    assert catalog._classify_script("汽油桶") == "Han"
+    assert catalog._classify_script("Drum") is None
+
+
+def test_when_parse_video_then_return_deduped_rows_in_one_array() -> None:
+    rows = catalog.parse_video(TEST_ASSETS / "input/catalog.mp4")
+    assert rows.shape == (440, *catalog.ROW_SHAPE) and rows.dtype == np.uint8
+    assert rows.flags.c_contiguous and rows.base is None  # Doesn't keep the frames or a larger buffer alive.
+
+    chunks = ocr.split_chunks(rows, workers=2)
+    assert isinstance(chunks[1], np.ndarray)
+    assert [len(chunk) for chunk in chunks] == [220, 220] and chunks[1].base is rows
+
+    # Slightly different renders of the same rows are dropped, distinct rows are all kept.
+    noise = np.random.default_rng(0).integers(-3, 4, rows.shape)
+    noisy_rows = np.concatenate([rows, np.clip(rows + noise, 0, 255).astype(np.uint8)])
+    with collect_stats() as stats:
+        assert np.array_equal(catalog._dedupe_rows(noisy_rows), rows)
+    assert stats.counters["rows_duplicate"] == len(rows)
+    shuffled_rows = noisy_rows[np.random.default_rng(0).permutation(len(noisy_rows))]
+    expected = catalog._dedupe_rows(shuffled_rows)
+    with mock.patch.object(catalog, "DEDUPE_BLOCK_ROWS", 7):  # Duplicates within and across many blocks
+        assert np.array_equal(catalog._dedupe_rows(shuffled_rows), expected)
+    assert len(catalog._dedupe_rows(noisy_rows, max_distance=0)) > len(rows)
+    assert np.array_equal(catalog._dedupe_rows(np.concatenate([rows, rows]), max_distance=0), rows)
+
+
+def test_when_catalog_scan_given_stream_then_ocr_batches_while_parsing() -> None:
+    batches: list[np.ndarray] = []
+
+    def recognize(rows: np.ndarray, lang: str, **kwargs: object) -> set[str]:
+        batches.append(rows)
+        return {"Wooden chair", "Wooden chiar"}
+
+    with mock.patch.object(catalog, "run_ocr", side_effect=recognize):
+        results = catalog.scan(TEST_ASSETS / "input/catalog.mp4", stream=True)
+    assert results.items == ["Wooden chair"] and results.unmatched == []
+    assert len(batches) > 1 and all(len(batch) >= catalog.STREAM_BATCH_ROWS for batch in batches[:-1])
+    assert np.array_equal(np.concatenate(batches), catalog.parse_video(TEST_ASSETS / "input/catalog.mp4"))
+
+
+def test_when_find_best_matches_given_icons_then_match_like_comparing_each_pair() -> None:
+    icons = critters.parse_video(TEST_ASSETS / "input/critters.mp4")
+    rng = np.random.default_rng(0)
+    icons += [np.roll(icon, 1, axis=1).view(critters.CritterIcon) for icon in icons[::4]]
+    for icon in icons[-len(icons) // 5 :]:
+        icon.critter_type = critters.CritterType.INSECTS
+        icon += rng.integers(0, 40, icon.shape, dtype=np.uint8)
+
+    def find_best_match(icon: np.ndarray, references: list[critters.CritterImage]) -> int:
+        similarities = [cv2.absdiff(icon, critter.img).mean() for critter in references]
+        sim1, sim2 = np.partition(similarities, kth=2)[:2]
+        if abs(sim1 - sim2) > critters.MATCH_MARGIN:
+            return int(np.argmin(similarities))
+        shifted = [
+            [cv2.absdiff(np.roll(icon, x, axis=1), c.img).sum() for x in critters.MATCH_SHIFTS] for c in references
+        ]
+        return int(np.argmin(np.min(shifted, axis=1)))
+
+    critter_db = critters._get_critter_db()
+    with collect_stats() as stats:
+        for critter_type in critters.CritterType:
+            typed_icons = [icon for icon in icons if icon.critter_type == critter_type]
+            matches = critters._find_best_matches(np.stack(typed_icons), critters._get_critter_matcher(critter_type))
+            assert matches.tolist() == [find_best_match(icon, critter_db[critter_type]) for icon in typed_icons]
+    assert stats.counters["matches_slow"] > 0 and stats.counters["matches_fast"] > 0
+
+
+def test_when_recipe_candidates_given_cards_then_select_colors_like_sorting_distances() -> None:
+    cards = np.stack(recipes.parse_video(TEST_ASSETS / "input/recipes.mp4"))
+    recipe_table = recipes._get_recipe_table()
+    color_db = recipes._get_color_db()
+    recipe_db = recipes._get_recipe_db()
+
+    for card, candidates in zip(cards, recipe_table.candidates(cards)):
+        bg_color = card[104:107, 62:66, :].mean(axis=(0, 1))
+        color_distances = sorted((np.linalg.norm(bg_color - color_db[c]), c) for c in color_db)
+        expected = [
+            recipe
+            for distance, color_id in color_distances
+            if distance - color_distances[0][0] <= 10
+            for recipe in recipe_db[color_id]
+        ]
+        assert [recipe_table.recipes[i] for i in candidates] == expected
+
+
+def test_when_recipe_match_given_many_candidates_then_shortlist_them_by_signature() -> None:
+    cards = recipes.parse_video(TEST_ASSETS / "input/recipes.mp4")
+    recipe_table = recipes._get_recipe_table()
+    cards = [card for card in cards if np.linalg.norm(card[28:84, 28:84].mean(axis=(0, 1)) - recipes.BG_COLOR) >= 5]
+
+    with collect_stats() as stats:
+        for card, candidates in zip(cards, recipe_table.candidates(np.stack(cards))):
+            match = recipes._find_best_match(card, recipe_table, candidates)
+            assert match == recipes._find_best_match(card, recipe_table, candidates, shortlist_size=len(candidates))
+    assert 0 < stats.counters["shortlist_hits"] <= stats.counters["shortlists"] < len(cards)
+
+    # Ties go to the candidate of the closest color, the shortlist doesn't reorder them.
+    images = np.zeros((5, *cards[0].shape), dtype=np.uint8)
+    images[3] = 255
+    table = mock.Mock(images=images, shortlist=mock.Mock(return_value=np.array([1, 4])))
+    assert recipes._find_best_match(images[0], table, np.array([4, 1, 3]), shortlist_size=2) == 4
+
+
+def test_when_image_pack_written_then_memory_map_it_until_images_change(tmp_path: Path) -> None:
+    (tmp_path / "generated").mkdir()
+    filenames = ["a.png", "b.png"]
+    for i, filename in enumerate(filenames):
+        cv2.imwrite(str(tmp_path / "generated" / filename), np.full((4, 4, 3), i, dtype=np.uint8))
+    decoded = read_image_pack(tmp_path, filenames)
+    assert not isinstance(decoded, np.memmap)
+
+    write_image_pack(tmp_path, filenames)
+    packed = read_image_pack(tmp_path, filenames)
+    assert isinstance(packed, np.memmap) and np.array_equal(packed, decoded)
+    assert not isinstance(read_image_pack(tmp_path, filenames[::-1]), np.memmap)
+
+    cv2.imwrite(str(tmp_path / "generated" / "b.png"), np.full((4, 4, 3), 9, dtype=np.uint8))
+    mtime = (tmp_path / "images.npy").stat().st_mtime + 1
+    os.utime(tmp_path / "generated" / "b.png", (mtime, mtime))
+    images = read_image_pack(tmp_path, filenames)
+    assert not isinstance(images, np.memmap) and images[1].max() == 9
+
+
+def test_when_hamming_index_searched_then_return_best_match_distance_and_margin() -> None:
+    rng = np.random.default_rng(0)
+    bits = rng.integers(0, 2, (20, 18, 18), dtype=np.uint8).astype(bool)
+    index = matching.HammingIndex(matching.pack_hashes(bits[:10]))
+    index.add(matching.pack_hashes(bits[10:]))
+    assert len(index) == 20
+
+    queries = bits[[3, 17]].copy()
+    queries[0, 0, :5] ^= True
+    best, distance, margin = index.search(matching.pack_hashes(queries))
+    expected = (queries.reshape(2, 1, -1) != bits.reshape(1, 20, -1)).sum(axis=2)
+    assert best.tolist() == [3, 17] and distance.tolist() == [5, 0]
+    assert margin.tolist() == (np.sort(expected, axis=1)[:, 1] - [5, 0]).tolist()